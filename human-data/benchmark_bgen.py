@@ -9,12 +9,31 @@ import time
 
 import simplebgen
 
+
+def benchmark_get_probabilities(bg, num_variants, args):
+    for j in range(num_variants):
+        P = bg.get_probabilities(j)
+
+
+def benchmark_iter_haplotypes(bg, num_variants, args):
+    for j, H in bg.iter_haplotypes(
+            0, num_variants, num_buffers=args.num_buffers,
+            num_threads=args.num_threads):
+        pass
+
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument("input", type=str, help="Input bgen file")
 parser.add_argument(
     "--num-variants", type=int, default=None,
     help="Number of variants to benchmark genotypes decoding performance on")
+parser.add_argument(
+    "--num-buffers", type=int, default=16,
+    help="Number of variants to decode ahead when prefetching")
+parser.add_argument(
+    "--num-threads", type=int, default=1,
+    help="Number of background decoder threads when prefetching")
 
 args = parser.parse_args()
 
@@ -22,15 +41,17 @@ bg = simplebgen.BgenReader(args.input)
 print("PID = ", os.getpid())
 print("num_samples  = ", bg.num_samples)
 print("num_variants = ", bg.num_variants)
-num_variants = 0
-before = time.perf_counter()
-for j in range(bg.num_variants):
-    if num_variants == args.num_variants:
-        break
-    P = bg.get_probabilities(j)
-    num_variants += 1
-
-duration = time.perf_counter() - before
+num_variants = bg.num_variants
+if args.num_variants is not None:
+    num_variants = min(args.num_variants, num_variants)
 total_genotypes = (2 * bg.num_samples * num_variants) / 10**6
-print("Iterated over {} variants in {:.2f}s @ {:.2f} M genotypes/s".format(
-    num_variants, duration, total_genotypes / duration))
+
+benchmarks = [
+    ("get_probabilities", benchmark_get_probabilities),
+    ("iter_haplotypes", benchmark_iter_haplotypes)]
+for name, func in benchmarks:
+    before = time.perf_counter()
+    func(bg, num_variants, args)
+    duration = time.perf_counter() - before
+    print("{}: iterated over {} variants in {:.2f}s @ {:.2f} M genotypes/s".format(
+        name, num_variants, duration, total_genotypes / duration))
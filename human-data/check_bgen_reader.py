@@ -24,6 +24,44 @@ def check():
     print("all good")
 
 
+def check_metadata():
+    filename = sys.argv[1]
+
+    bgen = bgen_reader.read_bgen(filename, verbose=False)
+    br = simplebgen.BgenReader(filename)
+    variants = bgen["variants"]
+    np.testing.assert_equal(br.positions, np.array(variants["pos"]))
+    np.testing.assert_equal(br.rsids, np.array(variants["rsid"]))
+    np.testing.assert_equal(br.nalleles, np.array(variants["nalleles"]))
+    np.testing.assert_equal(br.allele_ids, np.array(variants["allele_ids"]))
+
+    print("all good")
+
+
+def check_haplotypes():
+    filename = sys.argv[1]
+    br = simplebgen.BgenReader(filename)
+    N = 2 * br.num_samples
+    block_size = 16
+    H = np.empty((block_size, N), dtype=np.int8)
+    for start in range(0, br.num_variants, block_size):
+        stop = min(start + block_size, br.num_variants)
+        br.read_haplotypes(start, stop, H, num_threads=4)
+        for j in range(start, stop):
+            P = br.get_probabilities(j)
+            if P.shape[1] == 4:
+                P = P.astype(np.int8).reshape((N, 2))
+                np.testing.assert_equal(H[j - start] == 1, P[:, 1] == 1)
+                np.testing.assert_equal(H[j - start] == 0, P[:, 0] == 1)
+
+    H = np.empty((br.num_variants, N), dtype=np.int8)
+    br.read_haplotypes(0, br.num_variants, H)
+    for j, haplotypes in br.iter_haplotypes(num_buffers=4, num_threads=2):
+        np.testing.assert_equal(haplotypes, H[j])
+
+    print("all good")
+
+
 def memory():
     
     filename = sys.argv[1]
@@ -37,3 +75,5 @@ def memory():
 memory()
 
 # check()
+# check_haplotypes()
+# check_metadata()
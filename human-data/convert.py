@@ -4,7 +4,11 @@ Convert input data from various sources to samples format.
 import argparse
 import subprocess
 import os
+import os.path
 import sys
+import queue
+import threading
+import time
 
 import numpy as np
 import tsinfer
@@ -14,12 +18,65 @@ import pysam
 import tqdm
 import pandas as pd
 try:
-    import bgen_reader
-    # Local module used to work around slow genotype access in bgen_reader
+    # Local module used to work around slow access in bgen_reader
     import simplebgen
 except ImportError:
-    # bgen-reader isn't available for Python 3.4.
-    print("WARNING: Cannot import bgen reader")
+    print("WARNING: Cannot import simplebgen")
+
+
+# From the ancestral states README:
+# The convention for the sequence is:
+#    ACTG : high-confidence call, ancestral state supproted by the other two sequences
+#    actg : low-confindence call, ancestral state supported by one sequence only
+#    N    : failure, the ancestral state is not supported by any other sequence
+#    -    : the extant species contains an insertion at this postion
+#    .    : no coverage in the alignment
+# We encode this as a single byte per position: 0 for no ancestral state (anything
+# other than ACGT/acgt), 1-4 for high-confidence calls and 5-8 for low-confidence
+# calls.
+NO_ANCESTRAL_STATE = 0
+LOW_CONFIDENCE_OFFSET = 4
+ANCESTRAL_STATE_CODES = np.zeros(256, dtype=np.uint8)
+for _j, _base in enumerate("ACGT"):
+    ANCESTRAL_STATE_CODES[ord(_base)] = _j + 1
+    ANCESTRAL_STATE_CODES[ord(_base.lower())] = _j + 1 + LOW_CONFIDENCE_OFFSET
+ANCESTRAL_STATE_ALLELES = np.array(
+    [None, "A", "C", "G", "T", "a", "c", "g", "t"], dtype=object)
+
+
+def load_ancestral_states(fasta_filename, cache_filename=None, chunk_size=10**7):
+    """
+    Returns a read-only memory-mapped uint8 array of the encoded ancestral states
+    in the specified FASTA file, such that the value at index j is the state at
+    1-based position j. The encoded array is stored in cache_filename (which
+    defaults to the FASTA file name with ".npy" appended), and is only rebuilt
+    if it is missing or older than the FASTA file. Mapping the cached array
+    means that several converter processes can share the same pages.
+    """
+    if cache_filename is None:
+        cache_filename = fasta_filename + ".npy"
+    if (not os.path.exists(cache_filename) or
+            os.path.getmtime(cache_filename) < os.path.getmtime(fasta_filename)):
+        fasta = pysam.FastaFile(fasta_filename)
+        reference = fasta.references[0]
+        length = fasta.get_reference_length(reference)
+        # Write to a temporary file first so that other processes never see
+        # a partially written array.
+        tmp_filename = "{}.{}.tmp".format(cache_filename, os.getpid())
+        # NB! We put in an extra value at the start to convert to 1 based coords.
+        array = np.lib.format.open_memmap(
+            tmp_filename, mode="w+", dtype=np.uint8, shape=(length + 1,))
+        array[0] = NO_ANCESTRAL_STATE
+        for start in range(0, length, chunk_size):
+            end = min(start + chunk_size, length)
+            chunk = fasta.fetch(reference=reference, start=start, end=end)
+            array[start + 1: end + 1] = ANCESTRAL_STATE_CODES[
+                np.frombuffer(chunk.encode("ascii"), dtype=np.uint8)]
+        array.flush()
+        del array
+        fasta.close()
+        os.replace(tmp_filename, cache_filename)
+    return np.load(cache_filename, mmap_mode="r")
 
 
 @attr.s()
@@ -30,6 +87,167 @@ class Site(object):
     metadata = attr.ib({})
 
 
+@attr.s()
+class VcfRecord(object):
+    """
+    The fields of a VCF row that we need to classify it.
+    """
+    position = attr.ib(None)
+    id = attr.ib(None)
+    ref = attr.ib(None)
+    gt_bases = attr.ib(None)
+
+
+@attr.s()
+class VariantBatch(object):
+    """
+    A block of consecutive BGEN variants along with their decoded haplotypes.
+    """
+    position = attr.ib(None)
+    rsid = attr.ib(None)
+    num_alleles = attr.ib(None)
+    allele_id = attr.ib(None)
+    haplotypes = attr.ib(None)
+
+    def __len__(self):
+        return len(self.position)
+
+
+@attr.s()
+class StageStats(object):
+    name = attr.ib(None)
+    num_records = attr.ib(0)
+    busy_time = attr.ib(0.0)
+    wait_time = attr.ib(0.0)
+
+
+class Pipeline(object):
+    """
+    Runs a conversion as a parser -> classifier -> writer pipeline. The parser
+    and classifier run in their own threads and hand batches of records on to
+    the next stage through bounded queues, so that decoding, NumPy work and
+    writing to the SampleData can overlap. We record the time each stage
+    spends working and waiting on its neighbours, so we can see which one limits
+    the overall rate.
+
+    - batches is an iterator over batches of parsed records;
+    - classify(batch) returns a (num_records, sites) tuple;
+    - write(num_records, sites) returns True if we should stop.
+    """
+    def __init__(self, batches, classify, write, queue_size=8):
+        self.batches = batches
+        self.classify = classify
+        self.write = write
+        self.queue_size = queue_size
+        self.parser_stats = StageStats("parser")
+        self.classifier_stats = StageStats("classifier")
+        self.writer_stats = StageStats("writer")
+        self.stop_event = threading.Event()
+        self.errors = []
+
+    def _put(self, output_queue, item, stats):
+        before = time.perf_counter()
+        while not self.stop_event.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stats.wait_time += time.perf_counter() - before
+
+    def _get(self, input_queue, stats):
+        """
+        Returns the next item from the specified queue, or None if the input
+        is finished or we have been stopped.
+        """
+        before = time.perf_counter()
+        item = None
+        while True:
+            try:
+                item = input_queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    break
+        stats.wait_time += time.perf_counter() - before
+        return item
+
+    def _parser_thread(self, output_queue):
+        stats = self.parser_stats
+        try:
+            while not self.stop_event.is_set():
+                before = time.perf_counter()
+                batch = next(self.batches, None)
+                stats.busy_time += time.perf_counter() - before
+                if batch is None:
+                    break
+                stats.num_records += len(batch)
+                self._put(output_queue, batch, stats)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+        finally:
+            self._put(output_queue, None, stats)
+
+    def _classifier_thread(self, input_queue, output_queue):
+        stats = self.classifier_stats
+        try:
+            while True:
+                batch = self._get(input_queue, stats)
+                if batch is None:
+                    break
+                before = time.perf_counter()
+                num_records, sites = self.classify(batch)
+                stats.busy_time += time.perf_counter() - before
+                stats.num_records += num_records
+                self._put(output_queue, (num_records, sites), stats)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+        finally:
+            self._put(output_queue, None, stats)
+
+    def run(self):
+        parsed = queue.Queue(self.queue_size)
+        classified = queue.Queue(self.queue_size)
+        threads = [
+            threading.Thread(target=self._parser_thread, args=(parsed,)),
+            threading.Thread(
+                target=self._classifier_thread, args=(parsed, classified))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # The writer runs in this thread.
+        stats = self.writer_stats
+        try:
+            while True:
+                item = self._get(classified, stats)
+                if item is None:
+                    break
+                before = time.perf_counter()
+                stop = self.write(*item)
+                stats.busy_time += time.perf_counter() - before
+                stats.num_records += item[0]
+                if stop:
+                    break
+        finally:
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def report(self):
+        for stats in [self.parser_stats, self.classifier_stats, self.writer_stats]:
+            rate = 0
+            if stats.busy_time > 0:
+                rate = stats.num_records / stats.busy_time
+            print("{:<10} stage               : {} records; busy {:.2f}s "
+                  "({:.1f} records/s); waiting {:.2f}s".format(
+                    stats.name, stats.num_records, stats.busy_time, rate,
+                    stats.wait_time))
+
+
 def filter_duplicates(vcf):
     """
     Returns the variants from this VCF with duplicate sites filtered
@@ -52,12 +270,19 @@ def filter_duplicates(vcf):
 
 class Converter(object):
     """
-    Superclass of converters.
+    Superclass of converters. Subclasses provide the parser and classifier
+    stages of the conversion pipeline with parse_batches() and classify_batch().
     """
-    def __init__(self, data_file, ancestral_states, samples):
+    # Number of records passed between pipeline stages at a time, and the
+    # maximum number of batches waiting between any two stages.
+    batch_size = 1000
+    queue_size = 8
+
+    def __init__(self, data_file, ancestral_states, samples, num_threads=1):
         self.data_file = data_file
         self.ancestral_states = ancestral_states
         self.samples = samples
+        self.num_threads = num_threads
         self.num_samples = -1
         # ancestral states counters.
         self.num_no_ancestral_state = 0
@@ -86,38 +311,76 @@ class Converter(object):
     def process_metadata(self, metadata_file):
         pass
 
-    def get_ancestral_state(self, position):
-        # From the ancestral states README:
-        # The convention for the sequence is:
-        #    ACTG : high-confidence call, ancestral state supproted by the other two sequences
-        #    actg : low-confindence call, ancestral state supported by one sequence only
-        #    N    : failure, the ancestral state is not supported by any other sequence
-        #    -    : the extant species contains an insertion at this postion
-        #    .    : no coverage in the alignment
+    def num_records(self, max_sites=None):
+        """
+        Returns the number of records we expect to parse, for progress.
+        """
+        return None
 
-        ret = None
-        # NB: we assume that this array is modified so that the 1-indexed coordinates
-        # work correctly!
-        ancestral_state = self.ancestral_states[position]
-        if ancestral_state in [".", "N", "-"]:
-            self.num_no_ancestral_state += 1
-        elif ancestral_state.lower() == ancestral_state:
-            self.num_low_confidence_ancestral_state += 1
-        else:
-            assert ancestral_state in ["A", "C", "T", "G"]
-            ret = ancestral_state
-        return ret
+    def parse_batches(self, max_sites=None):
+        """
+        Returns an iterator over batches of parsed records.
+        """
+        raise NotImplementedError()
+
+    def classify_batch(self, batch):
+        """
+        Returns a (num_records, sites) tuple, where sites is the list of
+        Sites from the specified batch that we want to keep.
+        """
+        raise NotImplementedError()
+
+    def process_sites(self, show_progress=False, max_sites=None):
+        progress = tqdm.tqdm(
+            total=self.num_records(max_sites), disable=not show_progress)
+        num_sites = 0
+
+        def write(num_records, sites):
+            nonlocal num_sites
+            for site in sites:
+                if num_sites == max_sites:
+                    break
+                self.samples.add_site(
+                    position=site.position, genotypes=site.genotypes,
+                    alleles=site.alleles, metadata=site.metadata)
+                num_sites += 1
+            progress.update(num_records)
+            progress.set_postfix(used=str(num_sites))
+            return num_sites == max_sites
+
+        pipeline = Pipeline(
+            iter(self.parse_batches(max_sites)), self.classify_batch, write,
+            queue_size=self.queue_size)
+        pipeline.run()
+        progress.close()
+        # NB: if we stop at max_sites the counters also include the batches
+        # that were classified but not written.
+        self.report()
+        pipeline.report()
+
+    def get_ancestral_states(self, positions):
+        """
+        Returns the ancestral states for the specified array of 1-based positions
+        as an object array of alleles, in which sites without a high-confidence
+        ancestral state are None.
+        """
+        codes = self.ancestral_states[positions]
+        self.num_no_ancestral_state += int(np.sum(codes == NO_ANCESTRAL_STATE))
+        low_confidence = codes > LOW_CONFIDENCE_OFFSET
+        self.num_low_confidence_ancestral_state += int(np.sum(low_confidence))
+        codes[low_confidence] = NO_ANCESTRAL_STATE
+        return ANCESTRAL_STATE_ALLELES[codes]
 
 
 class VcfConverter(Converter):
 
-    def convert_genotypes(self, row, ancestral_state):
+    def convert_genotypes(self, record, ancestral_state):
         ret = None
         num_diploids = self.num_samples // 2
         a = np.zeros(self.num_samples, dtype=np.uint8)
         all_alleles = set([ancestral_state])
         # Fill in a with genotypes.
-        bases = np.array(row.gt_bases)
+        bases = np.array(record.gt_bases)
         for j in range(num_diploids):
             alleles = bases[j].split("|")
             if len(alleles) != 2:
@@ -147,32 +410,37 @@ class VcfConverter(Converter):
             else:
                 all_alleles.remove(ancestral_state)
                 alleles = [ancestral_state, all_alleles.pop()]
-                metadata = {"ID": row.ID, "REF": row.REF}
+                metadata = {"ID": record.id, "REF": record.ref}
                 ret = Site(
-                    position=row.POS, alleles=alleles, genotypes=a, metadata=metadata)
+                    position=record.position, alleles=alleles, genotypes=a,
+                    metadata=metadata)
         return ret
 
-    def process_sites(self, show_progress=False, max_sites=None):
-        num_data_sites = int(subprocess.check_output(
+    def num_records(self, max_sites=None):
+        return int(subprocess.check_output(
             ["bcftools", "index", "--nrecords", self.data_file]))
-        progress = tqdm.tqdm(total=num_data_sites, disable=not show_progress)
 
-        num_sites = 0
+    def parse_batches(self, max_sites=None):
+        batch = []
         for row in filter_duplicates(cyvcf2.VCF(self.data_file)):
-            ancestral_state = self.get_ancestral_state(row.POS)
+            batch.append(VcfRecord(
+                position=row.POS, id=row.ID, ref=row.REF, gt_bases=row.gt_bases))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def classify_batch(self, batch):
+        positions = np.array([record.position for record in batch])
+        ancestral_states = self.get_ancestral_states(positions)
+        sites = []
+        for record, ancestral_state in zip(batch, ancestral_states):
             if ancestral_state is not None:
-                site = self.convert_genotypes(row, ancestral_state)
+                site = self.convert_genotypes(record, ancestral_state)
                 if site is not None:
-                    self.samples.add_site(
-                        position=site.position, genotypes=site.genotypes,
-                        alleles=site.alleles, metadata=site.metadata)
-                    progress.set_postfix(used=str(num_sites))
-                    num_sites += 1
-                    if num_sites == max_sites:
-                        break
-            progress.update()
-        progress.close()
-        self.report()
+                    sites.append(site)
+        return len(batch), sites
 
 
 class ThousandGenomesConverter(VcfConverter):
@@ -452,6 +720,10 @@ class SgdpConverter(VcfConverter):
 
 
 class UkbbConverter(Converter):
+    # Each batch of variants needs batch_size * 2 * num_samples bytes for the
+    # haplotypes.
+    batch_size = 64
+    queue_size = 4
 
     def process_metadata(self, metadata_file, show_progress=False):
         # TODO Should make this an explicit requirement rather than hardcoding.
@@ -466,8 +738,6 @@ class UkbbConverter(Converter):
         metadata_df.sort_values(by="Order", inplace=True)
         metadata_df = metadata_df.set_index("Order")
 
-        bgen = bgen_reader.read_bgen(self.data_file, verbose=False)
-        sample_df = bgen['samples']
         keep_samples = []
         row_iter = tqdm.tqdm(
             metadata_df.iterrows(), total=len(metadata_df), disable=not show_progress)
@@ -475,45 +745,57 @@ class UkbbConverter(Converter):
             if not pd.isnull(index):
                 order = int(index)
                 if int(row.SampleID) not in withdrawn_ids:
-                    keep_samples.extend([2 * order, 2 * order + 1])
+                    keep_samples.append(order)
                     metadata = {}
                     for k, v in row.items():
                         metadata[k] = None if pd.isnull(v) else str(v)
                     self.samples.add_individual(ploidy=2, metadata=metadata)
-        self.num_samples = len(keep_samples)
-        self.keep_index = np.array(keep_samples, dtype=int)
-
-    def process_sites(self, show_progress=False, max_sites=None):
-
-        bgen = bgen_reader.read_bgen(self.data_file, verbose=False)
-        num_alleles = np.array(bgen["variants"]["nalleles"])
-        position = np.array(bgen["variants"]["pos"])
-        rsid = np.array(bgen["variants"]["rsid"])
-        allele_id = np.array(bgen["variants"]["allele_ids"])
-        del bgen
-
-        bg = simplebgen.BgenReader(self.data_file)
+        self.num_samples = 2 * len(keep_samples)
+        # The BGEN sample indexes for the individuals we keep, so that we never
+        # decode the withdrawn samples.
+        self.keep_samples = np.array(keep_samples, dtype=np.int64)
+        self.bgen = simplebgen.BgenReader(self.data_file, samples=self.keep_samples)
+
+    def num_records(self, max_sites=None):
+        num_variants = self.bgen.num_variants
+        if max_sites is not None:
+            num_variants = min(max_sites, num_variants)
+        return num_variants
+
+    def parse_batches(self, max_sites=None):
+        bg = self.bgen
         N = 2 * bg.num_samples
-        for j in tqdm.tqdm(range(bg.num_variants)):
-            ancestral_state = self.get_ancestral_state(position[j])
+        assert N == self.num_samples
+        num_variants = self.num_records(max_sites)
+        for start in range(0, num_variants, self.batch_size):
+            stop = min(start + self.batch_size, num_variants)
+            # Each batch needs its own buffer as it's queued for the classifier.
+            haplotypes = np.empty((stop - start, N), dtype=np.int8)
+            bg.read_haplotypes(start, stop, haplotypes, num_threads=self.num_threads)
+            yield VariantBatch(
+                position=bg.positions[start: stop], rsid=bg.rsids[start: stop],
+                num_alleles=bg.nalleles[start: stop],
+                allele_id=bg.allele_ids[start: stop], haplotypes=haplotypes)
+
+    def classify_batch(self, batch):
+        sites = []
+        ancestral_states = self.get_ancestral_states(batch.position)
+        for j, ancestral_state in enumerate(ancestral_states):
             if ancestral_state is not None:
-                alleles = allele_id[j].split(",")
-                if num_alleles[j] != 2 or ancestral_state not in alleles:
+                alleles = batch.allele_id[j].split(",")
+                if batch.num_alleles[j] != 2 or ancestral_state not in alleles:
                     self.num_non_biallelic += 1
                 elif any(len(allele) != 1 for allele in alleles):
                     self.num_indels += 1
                 else:
-                    P = bg.get_probabilities(j).astype(np.int8).reshape((N, 2))
-                    # The probabilities for each site is a (num_diploids, 4) array,
-                    # in the form (n0_a0, n0_a1, n1_a0, n1_a1). These are always zero
-                    # or one for the different alleles. We first flatten this array so
-                    # that it's (N, 2) and then generate the genotypes based on that.
-                    genotypes = np.zeros(N, dtype=np.int8)
+                    # The haplotypes are the index of the allele carried by each
+                    # of the N haplotypes, or -1 if this isn't known for certain.
+                    haplotypes = batch.haplotypes[j]
                     if ancestral_state == alleles[0]:
-                        genotypes[P[:, 1] == 1] = 1
+                        genotypes = (haplotypes == 1).astype(np.int8)
                         ref = alleles[0]
                     else:
-                        genotypes[P[:, 0] == 1] = 1
+                        genotypes = (haplotypes == 0).astype(np.int8)
                         ref = alleles[0]
                         alleles = alleles[::-1]
 
@@ -525,13 +807,11 @@ class UkbbConverter(Converter):
                     elif freq == self.num_samples - 1:
                         self.num_nmo_tons += 1
                     else:
-                        metadata = {"ID": rsid[j], "REF": ref}
-                        self.samples.add_site(
-                            position=float(position[j]), genotypes=genotypes[self.keep_index],
-                            alleles=alleles, metadata=metadata)
-            if j == max_sites:
-                break
-        self.report()
+                        metadata = {"ID": batch.rsid[j], "REF": ref}
+                        sites.append(Site(
+                            position=float(batch.position[j]), genotypes=genotypes,
+                            alleles=alleles, metadata=metadata))
+        return len(batch), sites
 
 
 def main():
@@ -563,6 +843,14 @@ def main():
     parser.add_argument(
         "--reference-name", default=None,
         help="The name of the reference for provenance.")
+    parser.add_argument(
+        "-t", "--num-threads", default=1, type=int,
+        help="The number of threads to use when decoding genotypes, where supported")
+    parser.add_argument(
+        "--ancestral-states-cache", default=None,
+        help=(
+            "File to store the encoded ancestral states array in. Defaults to the "
+            "ancestral states file name with '.npy' appended."))
 
     args = parser.parse_args()
 
@@ -579,9 +867,8 @@ def main():
     }
 
     # Get the ancestral states.
-    fasta = pysam.FastaFile(args.ancestral_states_file)
-    # NB! We put in an extra character at the start to convert to 1 based coords.
-    ancestral_states = "X" + fasta.fetch(reference=fasta.references[0])
+    ancestral_states = load_ancestral_states(
+        args.ancestral_states_file, args.ancestral_states_cache)
     # The largest possible site position is len(ancestral_states). Positions must
     # be strictly less than sequence_length, so we add 1.
     sequence_length = len(ancestral_states) + 1
@@ -596,7 +883,8 @@ def main():
                 path=args.output_file, num_flush_threads=2,
                 sequence_length=sequence_length) as samples:
             converter = converter_class[args.source](
-                    args.data_file, ancestral_states, samples)
+                    args.data_file, ancestral_states, samples,
+                    num_threads=args.num_threads)
             converter.process_metadata(args.metadata_file, args.progress)
             converter.process_sites(args.progress, args.max_variants)
             samples.record_provenance(
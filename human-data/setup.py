@@ -8,7 +8,7 @@ conda_base = pathlib.Path(sys.executable).parents[1]
 
 module1 = Extension(
     'simplebgen', 
-    libraries=["bgen", "zstd", "athr"],
+    libraries=["bgen", "zstd", "athr", "pthread"],
     include_dirs=[str(conda_base / "include"), np.get_include()],
     library_dirs=[str(conda_base / "lib")],
     sources = ['simplebgenmodule.c'])
@@ -3,6 +3,10 @@
 #include <Python.h>
 #include <structmember.h>
 #include <numpy/arrayobject.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
 #include "bgen.h"
 
 typedef struct {
@@ -10,13 +14,24 @@ typedef struct {
     struct bgen_file *bgen;
     struct bgen_vi *bgen_index;
     size_t num_variants;
+    /* The number of samples in the file, and the number we return values for. */
+    size_t num_file_samples;
     size_t num_samples;
+    /* The indexes of the samples we return values for, or NULL for all. */
+    size_t *sample_index;
+    /* Metadata columns, read once from the index when the file is opened. */
+    PyObject *sample_ids;
+    PyObject *variant_ids;
+    PyObject *rsids;
+    PyObject *chromosomes;
+    PyObject *positions;
+    PyObject *nalleles;
+    PyObject *allele_ids;
 } BgenReader;
 
 static void
 BgenReader_dealloc(BgenReader* self)
 {
-    Py_TYPE(self)->tp_free((PyObject*)self);
     if (self->bgen != NULL) {
         bgen_close(self->bgen);
         self->bgen = NULL;
@@ -25,17 +40,191 @@ BgenReader_dealloc(BgenReader* self)
         bgen_free_index(self->bgen_index);
         self->bgen_index = NULL;
     }
+    PyMem_Free(self->sample_index);
+    self->sample_index = NULL;
+    Py_XDECREF(self->sample_ids);
+    Py_XDECREF(self->variant_ids);
+    Py_XDECREF(self->rsids);
+    Py_XDECREF(self->chromosomes);
+    Py_XDECREF(self->positions);
+    Py_XDECREF(self->nalleles);
+    Py_XDECREF(self->allele_ids);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+make_string(struct bgen_str *str)
+{
+    return PyUnicode_FromStringAndSize(str->str, str->len);
+}
+
+/* Sets the sample metadata columns. Sample IDs are optional in BGEN, so
+ * sample_ids is None if they're not present. Otherwise, it contains the IDs of
+ * the samples we return values for. */
+static int
+BgenReader_read_samples_metadata(BgenReader *self)
+{
+    int ret = -1;
+    struct bgen_str *samples = NULL;
+    PyObject *sample_ids = NULL;
+    PyObject *value;
+    npy_intp dims[1];
+    size_t j, k;
+
+    if (!bgen_sample_ids_presence(self->bgen)) {
+        Py_INCREF(Py_None);
+        self->sample_ids = Py_None;
+        ret = 0;
+        goto out;
+    }
+    samples = bgen_read_samples(self->bgen, 0);
+    if (samples == NULL) {
+        PyErr_SetString(PyExc_ValueError, "error reading samples");
+        goto out;
+    }
+    dims[0] = self->num_samples;
+    sample_ids = PyArray_SimpleNew(1, dims, NPY_OBJECT);
+    if (sample_ids == NULL) {
+        goto out;
+    }
+    for (j = 0; j < self->num_samples; j++) {
+        k = self->sample_index == NULL ? j : self->sample_index[j];
+        value = make_string(&samples[k]);
+        if (value == NULL) {
+            goto out;
+        }
+        /* SETITEM increments the reference count */
+        PyArray_SETITEM((PyArrayObject *) sample_ids,
+                PyArray_GETPTR1((PyArrayObject *) sample_ids, j), value);
+        Py_DECREF(value);
+    }
+    self->sample_ids = sample_ids;
+    sample_ids = NULL;
+    ret = 0;
+out:
+    if (samples != NULL) {
+        bgen_free_samples(self->bgen, samples);
+    }
+    Py_XDECREF(sample_ids);
+    return ret;
+}
+
+/* Sets the variant metadata columns from the specified array of variants. The
+ * allele IDs for each variant are joined with commas, as in bgen_reader. */
+static int
+BgenReader_read_variants_metadata(BgenReader *self, struct bgen_var *variants)
+{
+    int ret = -1;
+    npy_intp dims[1];
+    size_t j;
+    int k;
+    PyArrayObject *variant_ids = NULL;
+    PyArrayObject *rsids = NULL;
+    PyArrayObject *chromosomes = NULL;
+    PyArrayObject *positions = NULL;
+    PyArrayObject *nalleles = NULL;
+    PyArrayObject *allele_ids = NULL;
+    PyObject *separator = NULL;
+    PyObject *alleles = NULL;
+    PyObject *value = NULL;
+    PyObject *columns[3];
+    struct bgen_str *strings[3];
+    int c;
+
+    dims[0] = self->num_variants;
+    variant_ids = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_OBJECT);
+    rsids = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_OBJECT);
+    chromosomes = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_OBJECT);
+    allele_ids = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_OBJECT);
+    positions = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_INT64);
+    nalleles = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_INT32);
+    separator = PyUnicode_FromString(",");
+    if (variant_ids == NULL || rsids == NULL || chromosomes == NULL
+            || allele_ids == NULL || positions == NULL || nalleles == NULL
+            || separator == NULL) {
+        goto out;
+    }
+    columns[0] = (PyObject *) variant_ids;
+    columns[1] = (PyObject *) rsids;
+    columns[2] = (PyObject *) chromosomes;
+    for (j = 0; j < self->num_variants; j++) {
+        strings[0] = &variants[j].id;
+        strings[1] = &variants[j].rsid;
+        strings[2] = &variants[j].chrom;
+        for (c = 0; c < 3; c++) {
+            value = make_string(strings[c]);
+            if (value == NULL) {
+                goto out;
+            }
+            PyArray_SETITEM((PyArrayObject *) columns[c],
+                    PyArray_GETPTR1((PyArrayObject *) columns[c], j), value);
+            Py_DECREF(value);
+            value = NULL;
+        }
+        alleles = PyList_New(variants[j].nalleles);
+        if (alleles == NULL) {
+            goto out;
+        }
+        for (k = 0; k < variants[j].nalleles; k++) {
+            value = make_string(&variants[j].allele_ids[k]);
+            if (value == NULL) {
+                goto out;
+            }
+            /* PyList_SET_ITEM steals the reference */
+            PyList_SET_ITEM(alleles, k, value);
+            value = NULL;
+        }
+        value = PyUnicode_Join(separator, alleles);
+        if (value == NULL) {
+            goto out;
+        }
+        PyArray_SETITEM(allele_ids, PyArray_GETPTR1(allele_ids, j), value);
+        Py_DECREF(value);
+        value = NULL;
+        Py_DECREF(alleles);
+        alleles = NULL;
+        *((npy_int64 *) PyArray_GETPTR1(positions, j)) = variants[j].position;
+        *((npy_int32 *) PyArray_GETPTR1(nalleles, j)) = variants[j].nalleles;
+    }
+    self->variant_ids = (PyObject *) variant_ids;
+    self->rsids = (PyObject *) rsids;
+    self->chromosomes = (PyObject *) chromosomes;
+    self->positions = (PyObject *) positions;
+    self->nalleles = (PyObject *) nalleles;
+    self->allele_ids = (PyObject *) allele_ids;
+    variant_ids = NULL;
+    rsids = NULL;
+    chromosomes = NULL;
+    positions = NULL;
+    nalleles = NULL;
+    allele_ids = NULL;
+    ret = 0;
+out:
+    Py_XDECREF(variant_ids);
+    Py_XDECREF(rsids);
+    Py_XDECREF(chromosomes);
+    Py_XDECREF(positions);
+    Py_XDECREF(nalleles);
+    Py_XDECREF(allele_ids);
+    Py_XDECREF(separator);
+    Py_XDECREF(alleles);
+    return ret;
 }
 
 static int
 BgenReader_init(BgenReader *self, PyObject *args, PyObject *kwds)
 {
     int ret = 0;
-    static char *kwlist[] = {"filename", NULL};
+    static char *kwlist[] = {"filename", "samples", NULL};
     struct bgen_var *variants = NULL;
     char *filename;
+    PyObject *samples_input = Py_None;
+    PyArrayObject *samples_array = NULL;
+    npy_int64 *samples;
+    npy_intp j;
 
-    if (! PyArg_ParseTupleAndKeywords(args, kwds, "s", kwlist, &filename)) {
+    if (! PyArg_ParseTupleAndKeywords(args, kwds, "s|O", kwlist,
+                &filename, &samples_input)) {
         ret = -1;
         goto out;
     }
@@ -46,19 +235,54 @@ BgenReader_init(BgenReader *self, PyObject *args, PyObject *kwds)
         goto out;
     }
     self->num_variants = bgen_nvariants(self->bgen);
-    self->num_samples = bgen_nsamples(self->bgen);
+    self->num_file_samples = bgen_nsamples(self->bgen);
+    self->num_samples = self->num_file_samples;
+    if (samples_input != Py_None) {
+        /* Only decode the specified subset of samples, in the specified order. */
+        samples_array = (PyArrayObject *) PyArray_FROMANY(samples_input, NPY_INT64,
+                1, 1, NPY_ARRAY_IN_ARRAY);
+        if (samples_array == NULL) {
+            ret = -1;
+            goto out;
+        }
+        self->num_samples = (size_t) PyArray_DIM(samples_array, 0);
+        self->sample_index = PyMem_Malloc((self->num_samples + 1) * sizeof(size_t));
+        if (self->sample_index == NULL) {
+            PyErr_NoMemory();
+            ret = -1;
+            goto out;
+        }
+        samples = (npy_int64 *) PyArray_DATA(samples_array);
+        for (j = 0; j < (npy_intp) self->num_samples; j++) {
+            if (samples[j] < 0 || samples[j] >= (npy_int64) self->num_file_samples) {
+                PyErr_SetString(PyExc_ValueError, "Sample index out of bounds.");
+                ret = -1;
+                goto out;
+            }
+            self->sample_index[j] = (size_t) samples[j];
+        }
+    }
 
-    /* Only doing this to initialise the index. Not sure if this is the correct approach
-     * to be honest. */
+    /* This also initialises the index, which we need to read genotypes. */
     variants = bgen_read_variants_metadata(self->bgen, &self->bgen_index, 0);
     if (variants == NULL) {
         PyErr_SetString(PyExc_ValueError, "error reading index");
+        ret = -1;
+        goto out;
+    }
+    if (BgenReader_read_variants_metadata(self, variants) != 0) {
+        ret = -1;
+        goto out;
+    }
+    if (BgenReader_read_samples_metadata(self) != 0) {
+        ret = -1;
         goto out;
     }
 out:
     if (variants != NULL) {
         bgen_free_variants_metadata(self->bgen, variants);
     }
+    Py_XDECREF(samples_array);
     return ret;
 }
 
@@ -70,6 +294,8 @@ BgenReader_get_probabilities(BgenReader* self, PyObject *args)
     struct bgen_vg *vg = NULL;
     npy_intp dims[2];
     PyArrayObject *probabilities = NULL;
+    double *buffer = NULL;
+    size_t j, ncombs;
      
     if (!PyArg_ParseTuple(args, "k", &variant)) {
         goto out;
@@ -83,29 +309,494 @@ BgenReader_get_probabilities(BgenReader* self, PyObject *args)
         PyErr_SetString(PyExc_ValueError, "Error getting variant.");
         goto out;
     }
+    ncombs = (size_t) bgen_ncombs(vg);
     dims[0] = self->num_samples;
-    dims[1] = bgen_ncombs(vg);
+    dims[1] = ncombs;
     probabilities = (PyArrayObject *) PyArray_SimpleNew(2, dims, NPY_FLOAT64);
     if (probabilities == NULL) {
         goto out;
     }
-    bgen_read_variant_genotype(self->bgen_index, vg, PyArray_DATA(probabilities));
+    if (self->sample_index == NULL) {
+        bgen_read_variant_genotype(self->bgen_index, vg, PyArray_DATA(probabilities));
+    } else {
+        buffer = PyMem_Malloc(self->num_file_samples * ncombs * sizeof(double));
+        if (buffer == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        bgen_read_variant_genotype(self->bgen_index, vg, buffer);
+        for (j = 0; j < self->num_samples; j++) {
+            memcpy((double *) PyArray_DATA(probabilities) + j * ncombs,
+                    buffer + self->sample_index[j] * ncombs, ncombs * sizeof(double));
+        }
+    }
     ret = (PyObject*) probabilities;
     probabilities = NULL;
 out:
     if (vg != NULL) {
         bgen_close_variant_genotype(self->bgen_index, vg);
     }
+    PyMem_Free(buffer);
     Py_XDECREF(probabilities);
     return ret;
 }
 
+/* Decodes the specified variant into the haplotypes array, which must have space
+ * for 2 * num_samples values. Each haplotype is set to the index of the allele
+ * it carries (0 or 1), or -1 if this is not known with probability 1. Variants
+ * that are not phased and biallelic are set to -1 throughout. Only the samples
+ * in the reader's sample_index are written. The probabilities buffer is used as
+ * scratch space, and is grown as necessary.
+ *
+ * NB: bgen_open_variant_genotype opens its own file handle for each variant,
+ * so it is safe to call this concurrently from different threads as long as
+ * each has its own probabilities buffer.
+ */
+static int
+decode_variant_haplotypes(BgenReader *reader, size_t variant,
+        double **probabilities, size_t *probabilities_size, int8_t *haplotypes)
+{
+    int ret = 0;
+    struct bgen_vi *index = reader->bgen_index;
+    size_t num_samples = reader->num_samples;
+    size_t num_file_samples = reader->num_file_samples;
+    struct bgen_vg *vg = NULL;
+    size_t j, k, ncombs;
+    double *p, *q;
+
+    vg = bgen_open_variant_genotype(index, variant);
+    if (vg == NULL) {
+        ret = -1;
+        goto out;
+    }
+    ncombs = (size_t) bgen_ncombs(vg);
+    if (ncombs != 4 || !bgen_phased(vg)) {
+        memset(haplotypes, -1, 2 * num_samples);
+        goto out;
+    }
+    if (num_file_samples * ncombs > *probabilities_size) {
+        p = realloc(*probabilities, num_file_samples * ncombs * sizeof(double));
+        if (p == NULL) {
+            ret = -1;
+            goto out;
+        }
+        *probabilities = p;
+        *probabilities_size = num_file_samples * ncombs;
+    }
+    p = *probabilities;
+    if (bgen_read_variant_genotype(index, vg, p) != 0) {
+        ret = -1;
+        goto out;
+    }
+    /* The probabilities for each sample are (h0_a0, h0_a1, h1_a0, h1_a1). */
+    for (j = 0; j < num_samples; j++) {
+        q = p + 4 * (reader->sample_index == NULL ? j : reader->sample_index[j]);
+        for (k = 0; k < 2; k++) {
+            if (q[2 * k] == 0.0 && q[2 * k + 1] == 1.0) {
+                haplotypes[2 * j + k] = 1;
+            } else if (q[2 * k] == 1.0 && q[2 * k + 1] == 0.0) {
+                haplotypes[2 * j + k] = 0;
+            } else {
+                haplotypes[2 * j + k] = -1;
+            }
+        }
+    }
+out:
+    if (vg != NULL) {
+        bgen_close_variant_genotype(index, vg);
+    }
+    return ret;
+}
+
+typedef struct {
+    BgenReader *reader;
+    size_t start;
+    size_t stop;
+    size_t thread_index;
+    size_t num_threads;
+    int8_t *haplotypes;
+    int err;
+} decode_work_t;
+
+static void *
+decode_worker(void *arg)
+{
+    decode_work_t *work = (decode_work_t *) arg;
+    double *probabilities = NULL;
+    size_t probabilities_size = 0;
+    size_t variant;
+    size_t N = 2 * work->reader->num_samples;
+
+    /* Threads take every num_threads-th variant in the range. */
+    for (variant = work->start + work->thread_index; variant < work->stop;
+            variant += work->num_threads) {
+        work->err = decode_variant_haplotypes(work->reader, variant,
+                &probabilities, &probabilities_size,
+                work->haplotypes + (variant - work->start) * N);
+        if (work->err != 0) {
+            break;
+        }
+    }
+    free(probabilities);
+    return NULL;
+}
+
+static PyObject *
+BgenReader_read_haplotypes(BgenReader* self, PyObject *args, PyObject *kwds)
+{
+    PyObject *ret = NULL;
+    static char *kwlist[] = {"start", "stop", "haplotypes", "num_threads", NULL};
+    unsigned long start, stop;
+    unsigned int num_threads = 1;
+    PyArrayObject *haplotypes = NULL;
+    npy_intp *shape;
+    decode_work_t *work = NULL;
+    pthread_t *threads = NULL;
+    size_t j, num_started = 0;
+    int err = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "kkO!|I", kwlist,
+                &start, &stop, &PyArray_Type, &haplotypes, &num_threads)) {
+        goto out;
+    }
+    if (start > stop || stop > self->num_variants) {
+        PyErr_SetString(PyExc_ValueError, "Variant index out of bounds.");
+        goto out;
+    }
+    if (PyArray_TYPE(haplotypes) != NPY_INT8
+            || !PyArray_IS_C_CONTIGUOUS(haplotypes)
+            || !PyArray_ISWRITEABLE(haplotypes)) {
+        PyErr_SetString(PyExc_TypeError,
+                "haplotypes must be a writeable C contiguous int8 array.");
+        goto out;
+    }
+    shape = PyArray_DIMS(haplotypes);
+    if (PyArray_NDIM(haplotypes) != 2 || shape[0] < (npy_intp) (stop - start)
+            || shape[1] != (npy_intp) (2 * self->num_samples)) {
+        PyErr_SetString(PyExc_ValueError,
+                "haplotypes must have shape (>= stop - start, 2 * num_samples).");
+        goto out;
+    }
+    if (num_threads < 1) {
+        num_threads = 1;
+    }
+    work = PyMem_Malloc(num_threads * sizeof(*work));
+    threads = PyMem_Malloc(num_threads * sizeof(*threads));
+    if (work == NULL || threads == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_threads; j++) {
+        work[j].reader = self;
+        work[j].start = start;
+        work[j].stop = stop;
+        work[j].thread_index = j;
+        work[j].num_threads = num_threads;
+        work[j].haplotypes = (int8_t *) PyArray_DATA(haplotypes);
+        work[j].err = 0;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    if (num_threads == 1) {
+        decode_worker(work);
+    } else {
+        for (j = 0; j < num_threads; j++) {
+            if (pthread_create(&threads[j], NULL, decode_worker, &work[j]) != 0) {
+                err = 1;
+                break;
+            }
+            num_started++;
+        }
+        for (j = 0; j < num_started; j++) {
+            pthread_join(threads[j], NULL);
+        }
+    }
+    Py_END_ALLOW_THREADS
+    if (err) {
+        PyErr_SetString(PyExc_RuntimeError, "Error starting decoder threads.");
+        goto out;
+    }
+    for (j = 0; j < num_threads; j++) {
+        if (work[j].err != 0) {
+            PyErr_SetString(PyExc_ValueError, "Error decoding variant.");
+            goto out;
+        }
+    }
+    ret = Py_BuildValue("");
+out:
+    PyMem_Free(work);
+    PyMem_Free(threads);
+    return ret;
+}
+
+/* Iterator over the haplotypes for a range of variants. Background threads
+ * decode variants ahead of the consumer into a ring of num_buffers reusable
+ * haplotype buffers. Variant v is stored in slot v % num_buffers, and
+ * slot_variant records which variant each slot currently holds. A slot may be
+ * overwritten as soon as the consumer has moved past the variant it holds, so
+ * producers only decode variant v once v < released + num_buffers.
+ */
+typedef struct {
+    PyObject_HEAD
+    BgenReader *reader;
+    size_t start;
+    size_t stop;
+    size_t num_buffers;
+    size_t num_threads;
+    int8_t *buffers;
+    size_t *slot_variant;
+    size_t next_read;
+    size_t released;
+    int stop_flag;
+    int err;
+    pthread_mutex_t mutex;
+    pthread_cond_t cond;
+    pthread_t *threads;
+    size_t num_started;
+    /* Indexes of the producer threads, passed to prefetch_worker. */
+    struct prefetch_arg {
+        void *iterator;
+        size_t thread_index;
+    } *args;
+} HaplotypeIterator;
+
+static void *
+prefetch_worker(void *arg)
+{
+    struct prefetch_arg *parg = (struct prefetch_arg *) arg;
+    HaplotypeIterator *self = (HaplotypeIterator *) parg->iterator;
+    BgenReader *reader = self->reader;
+    double *probabilities = NULL;
+    size_t probabilities_size = 0;
+    size_t variant, slot;
+    size_t N = 2 * reader->num_samples;
+    int err;
+
+    for (variant = self->start + parg->thread_index; variant < self->stop;
+            variant += self->num_threads) {
+        slot = variant % self->num_buffers;
+        pthread_mutex_lock(&self->mutex);
+        while (variant >= self->released + self->num_buffers && !self->stop_flag) {
+            pthread_cond_wait(&self->cond, &self->mutex);
+        }
+        pthread_mutex_unlock(&self->mutex);
+        if (self->stop_flag) {
+            break;
+        }
+        err = decode_variant_haplotypes(reader, variant,
+                &probabilities, &probabilities_size, self->buffers + slot * N);
+        pthread_mutex_lock(&self->mutex);
+        if (err != 0) {
+            self->err = err;
+        } else {
+            self->slot_variant[slot] = variant;
+        }
+        pthread_cond_broadcast(&self->cond);
+        pthread_mutex_unlock(&self->mutex);
+        if (err != 0) {
+            break;
+        }
+    }
+    free(probabilities);
+    return NULL;
+}
+
+static void
+HaplotypeIterator_dealloc(HaplotypeIterator* self)
+{
+    size_t j;
+
+    if (self->threads != NULL) {
+        pthread_mutex_lock(&self->mutex);
+        self->stop_flag = 1;
+        pthread_cond_broadcast(&self->cond);
+        pthread_mutex_unlock(&self->mutex);
+        Py_BEGIN_ALLOW_THREADS
+        for (j = 0; j < self->num_started; j++) {
+            pthread_join(self->threads[j], NULL);
+        }
+        Py_END_ALLOW_THREADS
+        pthread_mutex_destroy(&self->mutex);
+        pthread_cond_destroy(&self->cond);
+    }
+    PyMem_Free(self->threads);
+    PyMem_Free(self->args);
+    PyMem_Free(self->buffers);
+    PyMem_Free(self->slot_variant);
+    Py_XDECREF(self->reader);
+    PyObject_Del(self);
+}
+
+static PyObject *
+HaplotypeIterator_next(HaplotypeIterator *self)
+{
+    PyObject *ret = NULL;
+    PyArrayObject *haplotypes = NULL;
+    npy_intp dims[1];
+    size_t variant, slot;
+    int err;
+
+    if (self->next_read >= self->stop) {
+        /* Returning NULL without an exception set stops the iteration. */
+        goto out;
+    }
+    variant = self->next_read;
+    slot = variant % self->num_buffers;
+    Py_BEGIN_ALLOW_THREADS
+    pthread_mutex_lock(&self->mutex);
+    /* We're done with the previously returned variant, so its slot is free. */
+    self->released = variant;
+    pthread_cond_broadcast(&self->cond);
+    while (self->slot_variant[slot] != variant && !self->err) {
+        pthread_cond_wait(&self->cond, &self->mutex);
+    }
+    err = self->slot_variant[slot] != variant;
+    pthread_mutex_unlock(&self->mutex);
+    Py_END_ALLOW_THREADS
+    if (err) {
+        PyErr_SetString(PyExc_ValueError, "Error decoding variant.");
+        goto out;
+    }
+    dims[0] = 2 * self->reader->num_samples;
+    haplotypes = (PyArrayObject *) PyArray_New(&PyArray_Type, 1, dims, NPY_INT8,
+            NULL, self->buffers + slot * dims[0], 0, 0, NULL);
+    if (haplotypes == NULL) {
+        goto out;
+    }
+    /* The buffer is reused, so we don't allow the caller to modify it, and keep
+     * the iterator alive for as long as the array is. */
+    PyArray_CLEARFLAGS(haplotypes, NPY_ARRAY_WRITEABLE);
+    Py_INCREF(self);
+    if (PyArray_SetBaseObject(haplotypes, (PyObject *) self) != 0) {
+        goto out;
+    }
+    self->next_read++;
+    ret = Py_BuildValue("nO", (Py_ssize_t) variant, haplotypes);
+out:
+    Py_XDECREF(haplotypes);
+    return ret;
+}
+
+static PyTypeObject HaplotypeIteratorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "simplebgen.HaplotypeIterator",             /* tp_name */
+    sizeof(HaplotypeIterator), /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)HaplotypeIterator_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "Iterator over (variant, haplotypes) tuples",           /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    PyObject_SelfIter,         /* tp_iter */
+    (iternextfunc)HaplotypeIterator_next, /* tp_iternext */
+};
+
+static PyObject *
+BgenReader_iter_haplotypes(BgenReader* self, PyObject *args, PyObject *kwds)
+{
+    PyObject *ret = NULL;
+    static char *kwlist[] = {"start", "stop", "num_buffers", "num_threads", NULL};
+    unsigned long start = 0;
+    unsigned long stop = (unsigned long) self->num_variants;
+    unsigned int num_buffers = 16;
+    unsigned int num_threads = 1;
+    HaplotypeIterator *iterator = NULL;
+    size_t j;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|kkII", kwlist,
+                &start, &stop, &num_buffers, &num_threads)) {
+        goto out;
+    }
+    if (start > stop || stop > self->num_variants) {
+        PyErr_SetString(PyExc_ValueError, "Variant index out of bounds.");
+        goto out;
+    }
+    if (num_threads < 1) {
+        num_threads = 1;
+    }
+    if (num_buffers < num_threads) {
+        num_buffers = num_threads;
+    }
+    iterator = PyObject_New(HaplotypeIterator, &HaplotypeIteratorType);
+    if (iterator == NULL) {
+        goto out;
+    }
+    Py_INCREF(self);
+    iterator->reader = self;
+    iterator->start = start;
+    iterator->stop = stop;
+    iterator->num_buffers = num_buffers;
+    iterator->num_threads = num_threads;
+    iterator->next_read = start;
+    iterator->released = start;
+    iterator->stop_flag = 0;
+    iterator->err = 0;
+    iterator->num_started = 0;
+    iterator->threads = NULL;
+    iterator->args = PyMem_Malloc(num_threads * sizeof(*iterator->args));
+    iterator->slot_variant = PyMem_Malloc(num_buffers * sizeof(size_t));
+    iterator->buffers = PyMem_Malloc(num_buffers * 2 * self->num_samples);
+    if (iterator->args == NULL || iterator->slot_variant == NULL
+            || iterator->buffers == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_buffers; j++) {
+        iterator->slot_variant[j] = (size_t) -1;
+    }
+    pthread_mutex_init(&iterator->mutex, NULL);
+    pthread_cond_init(&iterator->cond, NULL);
+    iterator->threads = PyMem_Malloc(num_threads * sizeof(pthread_t));
+    if (iterator->threads == NULL) {
+        pthread_mutex_destroy(&iterator->mutex);
+        pthread_cond_destroy(&iterator->cond);
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_threads; j++) {
+        iterator->args[j].iterator = iterator;
+        iterator->args[j].thread_index = j;
+        if (pthread_create(&iterator->threads[j], NULL, prefetch_worker,
+                    &iterator->args[j]) != 0) {
+            PyErr_SetString(PyExc_RuntimeError, "Error starting decoder threads.");
+            goto out;
+        }
+        iterator->num_started++;
+    }
+    ret = (PyObject *) iterator;
+    iterator = NULL;
+out:
+    Py_XDECREF(iterator);
+    return ret;
+}
+
 static PyObject *
 BgenReader_get_num_samples(BgenReader *self, void *closure)
 {
     return Py_BuildValue("n", (Py_ssize_t) self->num_samples);
 }
 
+static PyObject *
+BgenReader_get_num_file_samples(BgenReader *self, void *closure)
+{
+    return Py_BuildValue("n", (Py_ssize_t) self->num_file_samples);
+}
+
 static PyObject *
 BgenReader_get_num_variants(BgenReader *self, void *closure)
 {
@@ -115,15 +806,45 @@ BgenReader_get_num_variants(BgenReader *self, void *closure)
 static PyMethodDef BgenReader_methods[] = {
     {"get_probabilities", (PyCFunction)BgenReader_get_probabilities, METH_VARARGS,
         "Return the probabilities for the specified variant."},
+    {"read_haplotypes", (PyCFunction)BgenReader_read_haplotypes,
+        METH_VARARGS|METH_KEYWORDS,
+        "Decode the variants in [start, stop) into the specified int8 array "
+        "of haplotype allele indexes, using num_threads threads."},
+    {"iter_haplotypes", (PyCFunction)BgenReader_iter_haplotypes,
+        METH_VARARGS|METH_KEYWORDS,
+        "Return an iterator over (variant, haplotypes) for the variants in "
+        "[start, stop), decoded ahead of time by num_threads background threads "
+        "into num_buffers reusable buffers. Each haplotypes array is read-only "
+        "and is only valid until the next iteration."},
     {NULL}  /* Sentinel */
 };
 
 static PyGetSetDef BgenReader_getsetters[] = {
-    {"num_samples", (getter)BgenReader_get_num_samples, NULL, "number of samples", NULL},
+    {"num_samples", (getter)BgenReader_get_num_samples, NULL,
+        "number of samples that values are returned for", NULL},
+    {"num_file_samples", (getter)BgenReader_get_num_file_samples, NULL,
+        "number of samples in the file", NULL},
     {"num_variants", (getter)BgenReader_get_num_variants, NULL, "number of variants", NULL},
     {NULL}  /* Sentinel */
 };
 
+static PyMemberDef BgenReader_members[] = {
+    {"sample_ids", T_OBJECT, offsetof(BgenReader, sample_ids), READONLY,
+        "IDs of the samples that values are returned for, or None if not present"},
+    {"variant_ids", T_OBJECT, offsetof(BgenReader, variant_ids), READONLY,
+        "variant IDs"},
+    {"rsids", T_OBJECT, offsetof(BgenReader, rsids), READONLY, "variant rsids"},
+    {"chromosomes", T_OBJECT, offsetof(BgenReader, chromosomes), READONLY,
+        "variant chromosomes"},
+    {"positions", T_OBJECT, offsetof(BgenReader, positions), READONLY,
+        "variant positions"},
+    {"nalleles", T_OBJECT, offsetof(BgenReader, nalleles), READONLY,
+        "number of alleles at each variant"},
+    {"allele_ids", T_OBJECT, offsetof(BgenReader, allele_ids), READONLY,
+        "comma separated allele IDs for each variant"},
+    {NULL}  /* Sentinel */
+};
+
 static PyTypeObject BgenReaderType = {
     PyVarObject_HEAD_INIT(NULL, 0)
     "simplebgen.BgenReader",             /* tp_name */
@@ -153,7 +874,7 @@ static PyTypeObject BgenReaderType = {
     0,                         /* tp_iter */
     0,                         /* tp_iternext */
     BgenReader_methods,             /* tp_methods */
-    0,             /* tp_members */
+    BgenReader_members,             /* tp_members */
     BgenReader_getsetters,     /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
@@ -182,6 +903,9 @@ PyInit_simplebgen(void)
     if (PyType_Ready(&BgenReaderType) < 0) {
         return NULL;
     }
+    if (PyType_Ready(&HaplotypeIteratorType) < 0) {
+        return NULL;
+    }
     import_array();
     m = PyModule_Create(&simplebgenmodule);
     if (m == NULL) {
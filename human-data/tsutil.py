@@ -10,6 +10,11 @@ import sys
 import io
 import csv
 import itertools
+import struct
+import multiprocessing
+import resource
+import hashlib
+import os
 import os.path
 
 import tskit
@@ -42,38 +47,132 @@ def run_match_samples(sample_data, ancestors_ts, num_threads):
         simplify=False, progress_monitor=progress_monitor)
 
 
+def reset_peak_memory():
+    """
+    Resets the peak resident set size of this process, if supported. Writing 5
+    to clear_refs resets VmHWM on Linux.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_memory():
+    """
+    Returns the peak resident set size of this process in bytes since the last
+    call to reset_peak_memory, or over the process lifetime if resetting is not
+    supported.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_dump(ts, filename):
+    """
+    Starts writing the specified tree sequence to the specified file in a
+    forked child process, so that the next round of augmentation can run at
+    the same time. The file is written to a temporary file and renamed by
+    finish_dump, so that a partially written checkpoint is never mistaken for
+    a complete one.
+    """
+    tmp_file = "{}.{}.tmp".format(filename, os.getpid())
+    process = multiprocessing.get_context("fork").Process(
+        target=ts.dump, args=(tmp_file,))
+    process.start()
+    return process, tmp_file, filename
+
+
+def finish_dump(dump):
+    process, tmp_file, filename = dump
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("Writing {} failed".format(filename))
+    os.replace(tmp_file, filename)
+
+
 def run_sequential_augment(args):
 
     base = ".".join(args.input.split(".")[:-1])
 
     sample_data = tsinfer.load(args.input)
     num_samples = sample_data.num_samples
-    ancestors_ts = tskit.load(base + ".ancestors.trees")
 
     # Compute the total samples required.
     n = 2
     total = 0
+    rounds = []
     while n < num_samples // 4:
+        rounds.append(n)
         total += n
         n *= 2
 
+    samples_file = base + ".augmented_samples.npy"
     np.random.seed(args.seed)
     samples = np.random.choice(np.arange(num_samples), size=total, replace=False)
-    np.save(base + ".augmented_samples.npy", samples)
-
-    n = 2
-    j = 0
-    while n < num_samples // 4:
-        augmented_file = base + ".augmented_{}.ancestors.trees".format(n)
-        final_file = base + ".augmented_{}.nosimplify.trees".format(n)
-        subset = samples[j: j + n]
-        subset.sort()
-        ancestors_ts = run_augment(
-            sample_data, ancestors_ts, subset, args.num_threads)
-        ancestors_ts.dump(augmented_file)
-        j += n
-        n *= 2
-        
+    if os.path.exists(samples_file):
+        # Resuming is only valid if we're augmenting the same samples.
+        if not np.array_equal(np.load(samples_file), samples):
+            raise ValueError("{} does not match the seed".format(samples_file))
+    else:
+        np.save(samples_file, samples)
+
+    # Find the rounds already completed by an earlier run.
+    completed = 0
+    while completed < len(rounds) and os.path.exists(
+            base + ".augmented_{}.ancestors.trees".format(rounds[completed])):
+        completed += 1
+    if completed > 0:
+        augmented_file = base + ".augmented_{}.ancestors.trees".format(
+            rounds[completed - 1])
+        print("Resuming from", augmented_file)
+        ancestors_ts = tskit.load(augmented_file)
+    else:
+        ancestors_ts = tskit.load(base + ".ancestors.trees")
+
+    stats_file = base + ".augmented_rounds.csv"
+    stats = []
+    if completed > 0 and os.path.exists(stats_file):
+        df = pd.read_csv(stats_file)
+        stats = df[df.num_samples.isin(rounds[:completed])].to_dict("records")
+    dump = None
+    j = sum(rounds[:completed])
+    try:
+        for n in rounds[completed:]:
+            augmented_file = base + ".augmented_{}.ancestors.trees".format(n)
+            subset = samples[j: j + n]
+            subset.sort()
+            reset_peak_memory()
+            before = time.time()
+            ancestors_ts = run_augment(
+                sample_data, ancestors_ts, subset, args.num_threads)
+            duration = time.time() - before
+            # The previous round's checkpoint was written while this round
+            # ran; wait for it before starting on this round's.
+            if dump is not None:
+                finish_dump(dump)
+            dump = start_dump(ancestors_ts, augmented_file)
+            stats.append({
+                "num_samples": n, "time": duration,
+                "peak_memory": get_peak_memory()})
+            print("Augmented {} samples in {:.2f} mins; peak memory = {}".format(
+                n, duration / 60,
+                humanize.naturalsize(stats[-1]["peak_memory"], binary=True)))
+            pd.DataFrame(stats).to_csv(stats_file, index=False)
+            j += n
+    finally:
+        # Keep the last completed checkpoint even if a later round fails.
+        if dump is not None:
+            finish_dump(dump)
+
+    final_file = base + ".augmented_{}.nosimplify.trees".format(rounds[-1])
     final_ts = run_match_samples(sample_data, ancestors_ts, args.num_threads)
     final_ts.dump(final_file)
 
@@ -139,22 +238,27 @@ def run_combine_ukbb_1kg(args):
 
     # Subset the sites down to the UKBB sites.
     tables = tg_ancestors_ts.dump_tables()
-    ukbb_sites = set(ukbb_samples.sites_position[:])
-    ancestors_sites = set(tables.sites.position[:])
-    intersecting_sites = ancestors_sites & ukbb_sites
-
-    print("Intersecting sites = ", len(intersecting_sites))
-    tables.sites.clear()
-    tables.mutations.clear()
-    for site in tg_ancestors_ts.sites():
-        if site.position in intersecting_sites:
-            # Sites must be 0/1 for the ancestors ts.
-            site_id = tables.sites.add_row(
-                position=site.position, ancestral_state="0")
-            assert len(site.mutations) == 1
-            mutation = site.mutations[0]
-            tables.mutations.add_row(
-                site=site_id, node=mutation.node, derived_state="1")
+    ukbb_position = ukbb_samples.sites_position[:]
+    keep_site = np.isin(tables.sites.position, ukbb_position)
+    intersecting_position = tables.sites.position[keep_site]
+    print("Intersecting sites = ", len(intersecting_position))
+    mutation_site = tables.mutations.site
+    mutation_node = tables.mutations.node
+    assert np.all(np.bincount(mutation_site, minlength=len(keep_site))[keep_site] == 1)
+    keep_mutation = keep_site[mutation_site]
+    site_id_map = np.cumsum(keep_site, dtype=np.int32) - 1
+    num_sites = len(intersecting_position)
+    num_mutations = np.sum(keep_mutation)
+    # Sites must be 0/1 for the ancestors ts.
+    tables.sites.set_columns(
+        position=intersecting_position,
+        ancestral_state=np.full(num_sites, ord("0"), dtype=np.int8),
+        ancestral_state_offset=np.arange(num_sites + 1, dtype=np.uint32))
+    tables.mutations.set_columns(
+        site=site_id_map[mutation_site[keep_mutation]],
+        node=mutation_node[keep_mutation],
+        derived_state=np.full(num_mutations, ord("1"), dtype=np.int8),
+        derived_state_offset=np.arange(num_mutations + 1, dtype=np.uint32))
 
     # Reduce this to the site topology now to make things as quick as possible.
     tables.simplify(reduce_to_site_topology=True, filter_sites=False)
@@ -222,11 +326,30 @@ def run_combine_ukbb_1kg(args):
             samples.add_individual(
                 ploidy=2, location=ind.location, metadata=ind.metadata)
 
-        for variant in tqdm.tqdm(ukbb_samples.variants(), total=ukbb_samples.num_sites):
-            if variant.site.position in intersecting_sites:
+        # Copy over the intersecting sites a chunk of UKBB sites at a time, so
+        # that we only decode the genotypes that we need.
+        intersecting_sites = np.where(np.isin(ukbb_position, intersecting_position))[0]
+        genotypes = ukbb_samples.sites_genotypes
+        alleles = ukbb_samples.sites_alleles[:]
+        metadata = ukbb_samples.sites_metadata[:]
+        chunk_size = args.chunk_size
+        if chunk_size is None:
+            chunk_size = genotypes.chunks[0]
+        progress = tqdm.tqdm(total=len(intersecting_sites))
+        for start in range(0, ukbb_samples.num_sites, chunk_size):
+            chunk_sites = intersecting_sites[
+                np.searchsorted(intersecting_sites, start):
+                np.searchsorted(intersecting_sites, start + chunk_size)]
+            if len(chunk_sites) == 0:
+                continue
+            stop = chunk_sites[-1] + 1
+            G = genotypes[chunk_sites[0]: stop, :2 * n]
+            for j in chunk_sites:
                 samples.add_site(
-                    position=variant.site.position, alleles=variant.alleles,
-                    genotypes=variant.genotypes[:2 * n], metadata=variant.site.metadata)
+                    position=ukbb_position[j], alleles=alleles[j],
+                    genotypes=G[j - chunk_sites[0]], metadata=metadata[j])
+            progress.update(len(chunk_sites))
+        progress.close()
 
         for timestamp, record in ukbb_samples.provenances():
             samples.add_provenance(timestamp, record)
@@ -236,175 +359,688 @@ def run_combine_ukbb_1kg(args):
     print(samples)
 
 
-def run_compute_1kg_ukbb_gnn(args):
-    ts = tskit.load(args.input)
-    tables = ts.tables
-    reference_sets = []
-    population_names = []
-    for pop in ts.populations():
-        reference_sets.append(np.where(tables.nodes.population == pop.id)[0].astype(np.int32))
-        name = json.loads(pop.metadata.decode())["name"]
-        population_names.append(name)
-
-    ind_metadata = [None for _ in range(ts.num_individuals)]
-    for ind in ts.individuals():
-        ind_metadata[ind.id] = json.loads(ind.metadata.decode())
-    
-    cols = {
-        "centre": [
-            ind_metadata[ts.node(u).individual]["CentreName"] for u in ts.samples()],
-        "sample_id": [
-            ind_metadata[ts.node(u).individual]["SampleID"] for u in ts.samples()],
-        "ethnicity": [
-            ind_metadata[ts.node(u).individual]["Ethnicity"] for u in ts.samples()],
-    }
-    print("Computing GNNs")
-    before = time.time()
+def file_hash(filename, block_size=2**24):
+    """
+    Returns the SHA-256 hex digest of the contents of the specified file.
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        block = f.read(block_size)
+        while len(block) > 0:
+            h.update(block)
+            block = f.read(block_size)
+    return h.hexdigest()
+
+
+def cached_file_hash(filename):
+    """
+    Returns the SHA-256 hex digest of the specified file, which is cached in
+    a .sha256 sidecar file keyed by the file's size and modification time,
+    so that the file is only read again when either of these changes.
+    """
+    cache_file = filename + ".sha256"
+    stat = os.stat(filename)
+    key = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["size"] == key["size"] and cached["mtime_ns"] == key["mtime_ns"]:
+            return cached["hash"]
+    key["hash"] = file_hash(filename)
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(key, f)
+    os.replace(tmp_file, cache_file)
+    return key["hash"]
+
+
+def metadata_column(values):
+    """
+    Returns a NumPy array for the specified list of decoded metadata values.
+    Integer columns become int64 with -1 for missing values; other numeric
+    columns become float64 with NaN for missing values and everything else
+    becomes a string column with "" for missing values.
+    """
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+        return np.array([-1 if v is None else v for v in values], dtype=np.int64)
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array([
+        "" if v is None else (v if isinstance(v, str) else json.dumps(v))
+        for v in values], dtype=str)
+
+
+KASTORE_MAGIC = b"\x89KAS\r\n\x1a\n"
+KASTORE_DTYPES = [
+    "<i1", "<u1", "<i2", "<u2", "<i4", "<u4", "<i8", "<u8", "<f4", "<f8"]
+KASTORE_DESCRIPTOR = np.dtype([
+    ("type", "u1"), ("reserved", "V7"), ("key_start", "<u8"), ("key_len", "<u8"),
+    ("array_start", "<u8"), ("array_len", "<u8"), ("padding", "V24")])
+
+
+def load_columns(filename, keys):
+    """
+    Returns a dict mapping each of the specified keys, such as "edges/child",
+    to a read-only memory map of that column in the specified .trees file.
+    Only the kastore header is read, so the other columns never touch RAM.
+    """
+    with open(filename, "rb") as f:
+        header = f.read(64)
+        if header[:8] != KASTORE_MAGIC:
+            raise ValueError("Not a kastore file: {}".format(filename))
+        version_major = struct.unpack("<H", header[8:10])[0]
+        if version_major != 1:
+            raise ValueError("Unsupported kastore version {}".format(version_major))
+        num_items = struct.unpack("<I", header[12:16])[0]
+        descriptors = np.frombuffer(
+            f.read(num_items * KASTORE_DESCRIPTOR.itemsize), dtype=KASTORE_DESCRIPTOR)
+        key_start = int(np.min(descriptors["key_start"], initial=0))
+        key_end = int(np.max(
+            descriptors["key_start"] + descriptors["key_len"], initial=0))
+        f.seek(key_start)
+        key_data = f.read(key_end - key_start)
+
+    columns = {}
+    for descriptor in descriptors:
+        start = int(descriptor["key_start"]) - key_start
+        key = key_data[start: start + int(descriptor["key_len"])].decode()
+        if key in keys:
+            dtype = KASTORE_DTYPES[descriptor["type"]]
+            shape = (int(descriptor["array_len"]),)
+            if shape[0] == 0:
+                # Can't memory map zero length arrays.
+                columns[key] = np.zeros(shape, dtype=dtype)
+            else:
+                columns[key] = np.memmap(
+                    filename, dtype=dtype, mode="r",
+                    offset=int(descriptor["array_start"]), shape=shape)
+    missing = set(keys) - set(columns.keys())
+    if len(missing) > 0:
+        raise KeyError("Columns not found in {}: {}".format(
+            filename, ", ".join(sorted(missing))))
+    return columns
+
+
+def decode_metadata_columns(metadata, offset):
+    """
+    Decodes the JSON metadata in the specified ragged metadata column into a
+    dict mapping each metadata key to a column with one value for every row.
+    """
+    metadata = np.asarray(metadata).tobytes()
+    num_rows = len(offset) - 1
+    values = collections.OrderedDict()
+    # Rows with no metadata are treated as missing values for all keys.
+    for j in np.where(offset[1:] > offset[:-1])[0]:
+        md = json.loads(metadata[offset[j]: offset[j + 1]].decode())
+        for key, value in md.items():
+            if key not in values:
+                values[key] = [None for _ in range(num_rows)]
+            values[key][j] = value
+    return collections.OrderedDict(
+        (key, metadata_column(column)) for key, column in values.items())
+
+
+def load_metadata_columns(filename):
+    """
+    Returns the decoded individual, population and node metadata for the tree
+    sequence in the specified file as a dict with keys "individuals",
+    "populations" and "nodes", each mapping metadata keys to columns (see
+    decode_metadata_columns), along with the node_flags, node_population and
+    node_individual columns from the node table and the hash of the file.
+    The columns are cached in a sidecar file, which is rebuilt if the hash of
+    the .trees file changes. The hash itself is cached (see cached_file_hash),
+    so the .trees file is only read again if its size or mtime changes.
+    """
+    cache_file = filename + ".metadata.npz"
+    digest = cached_file_hash(filename)
+    columns = None
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            if str(data["hash"]) == digest:
+                columns = {"individuals": {}, "populations": {}, "nodes": {}}
+                for name in data.files:
+                    if "/" in name:
+                        table, key = name.split("/", 1)
+                        columns[table][key] = data[name]
+                    elif name != "hash":
+                        columns[name] = data[name]
+    if columns is None:
+        tables = load_columns(filename, [
+            "individuals/metadata", "individuals/metadata_offset",
+            "populations/metadata", "populations/metadata_offset",
+            "nodes/metadata", "nodes/metadata_offset",
+            "nodes/flags", "nodes/population", "nodes/individual"])
+        columns = {
+            name: decode_metadata_columns(
+                tables[name + "/metadata"], tables[name + "/metadata_offset"])
+            for name in ["individuals", "populations", "nodes"]}
+        columns["node_flags"] = np.array(tables["nodes/flags"])
+        columns["node_population"] = np.array(tables["nodes/population"])
+        columns["node_individual"] = np.array(tables["nodes/individual"])
+        data = {"hash": np.array(digest)}
+        for name, value in columns.items():
+            if isinstance(value, dict):
+                for key, column in value.items():
+                    data[name + "/" + key] = column
+            else:
+                data[name] = value
+        # Write to a temporary file first so we never leave a partial cache.
+        tmp_file = "{}.{}.tmp.npz".format(cache_file, os.getpid())
+        np.savez(tmp_file, **data)
+        os.replace(tmp_file, cache_file)
+    columns["hash"] = digest
+    return columns
+
+
+def get_individual_nodes(columns):
+    """
+    Returns the (nodes, strands) arrays for all nodes associated with an
+    individual, ordered by individual and then node ID, where strands gives
+    the index of each node within its individual.
+    """
+    node_individual = columns["node_individual"]
+    nodes = np.where(node_individual != tskit.NULL)[0].astype(np.int32)
+    nodes = nodes[np.argsort(node_individual[nodes], kind="stable")]
+    individual = node_individual[nodes]
+    strands = np.arange(len(nodes)) - np.searchsorted(individual, individual)
+    return nodes, strands
+
+
+class ChildEdgeIndex(object):
+    """
+    Index of the edges in a tree sequence grouped by child in CSR form, so
+    that the edges for node u are at offset[u]: offset[u + 1] in the left,
+    right and parent arrays, sorted by left coordinate.
+    """
+    def __init__(self, left, right, parent, child, num_nodes):
+        order = np.lexsort((left, child))
+        self.left = left[order]
+        self.right = right[order]
+        self.parent = parent[order]
+        self.child = child[order]
+        self.offset = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(child, minlength=num_nodes), out=self.offset[1:])
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns the index for the tree sequence in the specified file, reading
+        only the edge columns and the length of the node table.
+        """
+        columns = load_columns(filename, [
+            "edges/left", "edges/right", "edges/parent", "edges/child",
+            "nodes/flags"])
+        return cls(
+            columns["edges/left"], columns["edges/right"],
+            columns["edges/parent"], columns["edges/child"],
+            len(columns["nodes/flags"]))
+
+    @classmethod
+    def from_tables(cls, tables):
+        edges = tables.edges
+        return cls(
+            edges.left, edges.right, edges.parent, edges.child,
+            tables.nodes.num_rows)
+
+    def num_edges(self, nodes):
+        return self.offset[nodes + 1] - self.offset[nodes]
+
+    def gather(self, nodes):
+        """
+        Returns the (group, index) arrays for the edges of the specified
+        nodes, where index gives the position of each edge in the index
+        and group the position of its child in nodes.
+        """
+        nodes = np.asarray(nodes)
+        counts = self.num_edges(nodes)
+        group = np.repeat(np.arange(len(nodes)), counts)
+        group_start = np.cumsum(counts) - counts
+        index = self.offset[nodes][group] + np.arange(len(group)) - group_start[group]
+        return group, index
+
+    def n50(self, nodes, sequence_length):
+        """
+        Returns the N50 of the edge lengths for each of the specified nodes,
+        i.e. the length of the first edge in decreasing order of length at
+        which the cumulative length reaches half of the sequence length. The
+        value is NaN for nodes whose edges cover less than this.
+        """
+        group, index = self.gather(nodes)
+        length = self.right[index] - self.left[index]
+        order = np.lexsort((-length, group))
+        group = group[order]
+        length = length[order]
+        cumulative = np.cumsum(length)
+        group_start = np.searchsorted(group, group)
+        cumulative -= cumulative[group_start] - length[group_start]
+        reached = np.where(cumulative >= sequence_length / 2)[0]
+        first = np.searchsorted(group[reached], np.arange(len(nodes)))
+        found = first < len(reached)
+        found[found] = group[reached[first[found]]] == np.where(found)[0]
+        n50 = np.full(len(nodes), np.nan)
+        n50[found] = length[reached[first[found]]]
+        return n50
+
+    def close_breakpoints(self, nodes_a, nodes_b, distance):
+        """
+        Returns the number of pairs of edge left coordinates within the
+        specified distance of each other for each pair of nodes in nodes_a
+        and nodes_b.
+        """
+        group_a, index_a = self.gather(nodes_a)
+        group_b, index_b = self.gather(nodes_b)
+        # Shift each group into its own disjoint range of coordinates so that
+        # we can merge all groups with a single pair of searchsorted calls.
+        stride = np.max(self.right, initial=0) + 2 * distance + 1
+        x = group_a * stride + self.left[index_a]
+        y = group_b * stride + self.left[index_b]
+        count = (
+            np.searchsorted(y, x + distance, side="right") -
+            np.searchsorted(y, x - distance, side="left"))
+        return np.bincount(group_a, weights=count, minlength=len(nodes_a)).astype(int)
+
+    def window_coverage(self, nodes, windows):
+        """
+        Returns the (num_windows, len(nodes)) array giving the span within
+        each of the windows defined by the specified breakpoints over which
+        each of the specified nodes has a parent.
+        """
+        group, index = self.gather(nodes)
+        left = self.left[index]
+        right = self.right[index]
+        first = np.searchsorted(windows, left, side="right") - 1
+        last = np.searchsorted(windows, right, side="left") - 1
+        # Split edges spanning several windows into one piece per window.
+        count = last - first + 1
+        piece = np.repeat(np.arange(len(index)), count)
+        window = first[piece] + np.arange(len(piece)) - np.repeat(
+            np.cumsum(count) - count, count)
+        span = (
+            np.minimum(right[piece], windows[window + 1]) -
+            np.maximum(left[piece], windows[window]))
+        coverage = np.zeros((len(windows) - 1, len(nodes)))
+        np.add.at(coverage, (window, group[piece]), span)
+        return coverage
+
+    def parent_coverage(self, nodes, sequence_length):
+        """
+        Returns the (group, parent, coverage) arrays giving the fraction of
+        the sequence covered by each distinct parent of the specified nodes.
+        The rows are sorted by group, the position of each child in nodes,
+        and then by decreasing coverage.
+        """
+        group, index = self.gather(nodes)
+        parent = self.parent[index]
+        length = self.right[index] - self.left[index]
+        order = np.lexsort((parent, group))
+        group = group[order]
+        parent = parent[order]
+        start = np.where(np.diff(group, prepend=-1) | np.diff(parent, prepend=-1))[0]
+        coverage = np.add.reduceat(length[order], start) / sequence_length
+        group = group[start]
+        parent = parent[start]
+        order = np.lexsort((-coverage, group))
+        return group[order], parent[order], coverage[order]
+
+
+def get_augmented_samples(columns):
+    # Note that we don't necessarily recover all of the samples that were
+    # augmented here because they might have been simplified out.
+    ids = np.where(columns["node_flags"] == tsinfer.NODE_IS_SAMPLE_ANCESTOR)[0]
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return columns["nodes"]["sample"][ids]
+
+
+def population_partition(columns, mask=None):
+    """
+    Returns the (labels, names) partition of nodes by population, where
+    nodes for which mask is False have label -1 and are not in any reference
+    set.
+    """
+    labels = columns["node_population"].astype(np.int32)
+    if mask is not None:
+        labels[~mask] = tskit.NULL
+    return labels, columns["populations"]["name"]
+
+
+def region_partition(columns, region_key, mask=None):
+    """
+    Returns the (labels, names) partition of nodes by the region of their
+    population, given by the specified population metadata key.
+    """
+    names, population_region = np.unique(
+        columns["populations"][region_key], return_inverse=True)
+    node_population = columns["node_population"]
+    labels = np.full(len(node_population), tskit.NULL, dtype=np.int32)
+    index = node_population != tskit.NULL
+    if mask is not None:
+        index &= mask
+    labels[index] = population_region.reshape(-1)[node_population[index]]
+    return labels, names
+
+
+_gnn_worker_state = None
+
+
+def gnn_worker_init(filename, focal, reference_sets, num_threads):
+    global _gnn_worker_state
+    _gnn_worker_state = tskit.load(filename), focal, reference_sets, num_threads
+
+
+def gnn_window_worker(work):
+    j, left, right = work
+    ts, focal, reference_sets, num_threads = _gnn_worker_state
+    ts = ts.keep_intervals([[left, right]], simplify=False)
     A = ts.genealogical_nearest_neighbours(
-        ts.samples(), reference_sets, num_threads=args.num_threads)
-    duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
+        focal, reference_sets, num_threads=num_threads)
+    return j, A
+
+
+def windowed_gnn(filename, focal, reference_sets, windows, num_processes=1,
+                 num_threads=1):
+    """
+    Returns the (num_windows, num_focal, num_reference_sets) array of GNN
+    proportions of the focal nodes within each of the windows defined by the
+    specified breakpoints. Windows are processed in parallel by the specified
+    number of processes, each of which loads its own copy of the tree sequence.
+    """
+    num_windows = len(windows) - 1
+    A = np.zeros((num_windows, len(focal), len(reference_sets)))
+    work = [(j, windows[j], windows[j + 1]) for j in range(num_windows)]
+    initargs = (filename, focal, reference_sets, num_threads)
+    if num_processes <= 1:
+        gnn_worker_init(*initargs)
+        results = map(gnn_window_worker, work)
+        for j, A_window in tqdm.tqdm(results, total=num_windows):
+            A[j] = A_window
+    else:
+        with multiprocessing.Pool(
+                processes=num_processes, initializer=gnn_worker_init,
+                initargs=initargs) as pool:
+            results = pool.imap_unordered(gnn_window_worker, work)
+            for j, A_window in tqdm.tqdm(results, total=num_windows):
+                A[j] = A_window
+    return A
+
+
+def merge_windowed_gnn(A, coverage):
+    """
+    Returns the genome-wide GNN proportions from the specified per-window
+    proportions, weighting each window by the span over which each focal
+    node has a parent within it.
+    """
+    total = np.sum(coverage, axis=0)
+    merged = np.sum(A * coverage[:, :, np.newaxis], axis=0)
+    index = total > 0
+    merged[index] /= total[index, np.newaxis]
+    return merged
+
+
+def compute_partition_gnn(filename, focal, partitions, num_threads=1, windows=None,
+                          num_processes=1):
+    """
+    Returns a dict mapping the name of each of the specified partitions to
+    the matrix of GNN proportions for the focal nodes, where partitions maps
+    names to (labels, names) tuples. Partitions covering the same nodes are
+    computed together in a single traversal over the reference sets of their
+    common refinement; the proportions for each partition are then the sums
+    of the proportions for the refined sets making up each of its sets. If
+    windows is specified, the result for each partition is the array of
+    per-window matrices computed by windowed_gnn.
+    """
+    ts = None
+    if windows is None:
+        ts = tskit.load(filename)
+    groups = collections.OrderedDict()
+    for name, (labels, _) in partitions.items():
+        key = hashlib.sha256(np.packbits(labels != tskit.NULL).tobytes()).digest()
+        groups.setdefault(key, []).append(name)
+    results = {}
+    for names in groups.values():
+        labels = np.vstack([partitions[name][0] for name in names])
+        covered = np.where(labels[0] != tskit.NULL)[0].astype(np.int32)
+        refinement, inverse = np.unique(
+            labels[:, covered], axis=1, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        num_refined = refinement.shape[1]
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(num_refined + 1))
+        reference_sets = [
+            covered[order[bounds[j]: bounds[j + 1]]] for j in range(num_refined)]
+        print("Computing GNN for", ", ".join(names), "using", num_refined,
+              "reference sets")
+        if windows is None:
+            A = ts.genealogical_nearest_neighbours(
+                focal, reference_sets, num_threads=num_threads)
+        else:
+            A = windowed_gnn(
+                filename, focal, reference_sets, windows, num_processes,
+                num_threads)
+        for name, row in zip(names, refinement):
+            num_sets = len(partitions[name][1])
+            membership = np.zeros((num_refined, num_sets))
+            membership[np.arange(num_refined), row] = 1
+            results[name] = A @ membership
+    return results
+
+
+def gnn_cache_key(digest, focal, labels, names, windows=None):
+    """
+    Returns the key for the cached GNN matrix of the specified focal nodes
+    and partition of the tree sequence with the specified file hash.
+    """
+    h = hashlib.sha256()
+    h.update(digest.encode())
+    h.update(np.asarray(focal, dtype=np.int32).tobytes())
+    h.update(np.asarray(labels, dtype=np.int32).tobytes())
+    h.update(json.dumps([str(name) for name in names]).encode())
+    if windows is not None:
+        h.update(b"windows")
+        h.update(np.asarray(windows, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def compute_gnn(filename, columns, focal, partitions, num_threads=1, windows=None,
+                num_processes=1, windows_file=None):
+    """
+    Returns the GNN proportions of the specified focal nodes for each of the
+    specified partitions as an ordered dict of columns, one per reference set.
+    Results are cached in the .gnn_cache directory next to the tree sequence
+    file, keyed by the file hash, the focal nodes and the partition, and the
+    tree sequence is only loaded if some partitions are not cached.
+
+    If windows is specified, the GNN is computed separately for each window
+    in parallel and the returned columns are the span-weighted average over
+    windows. The per-window proportions and spans are written to windows_file.
+    """
+    cache_dir = filename + ".gnn_cache"
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_files = {}
+    results = {}
+    missing = collections.OrderedDict()
+    for name, (labels, names) in partitions.items():
+        key = gnn_cache_key(columns["hash"], focal, labels, names, windows)
+        cache_files[name] = os.path.join(cache_dir, key + ".npy")
+        if os.path.exists(cache_files[name]):
+            print("Loaded cached GNN for", name)
+            results[name] = np.load(cache_files[name])
+        else:
+            missing[name] = partitions[name]
+
+    if len(missing) > 0:
+        print("Computing GNNs for", len(focal), "samples")
+        before = time.time()
+        computed = compute_partition_gnn(
+            filename, focal, missing, num_threads, windows, num_processes)
+        duration = time.time() - before
+        print("Done in {:.2f} mins".format(duration / 60))
+        for name, A in computed.items():
+            tmp_file = "{}.{}.tmp.npy".format(cache_files[name], os.getpid())
+            np.save(tmp_file, A)
+            os.replace(tmp_file, cache_files[name])
+        results.update(computed)
+
+    set_names = []
+    for name, (_, names) in partitions.items():
+        for set_name in names:
+            if set_name in set_names:
+                raise ValueError("Duplicate reference set name: {}".format(set_name))
+            set_names.append(set_name)
+    A = np.concatenate([results[name] for name in partitions.keys()], axis=-1)
+    if windows is not None:
+        coverage = ChildEdgeIndex.load(filename).window_coverage(focal, windows)
+        if windows_file is not None:
+            np.savez(
+                windows_file, windows=windows, focal=focal,
+                names=np.array(set_names, dtype=str), gnn=A, coverage=coverage)
+        A = merge_windowed_gnn(A, coverage)
+    return collections.OrderedDict(
+        (set_name, A[:, j]) for j, set_name in enumerate(set_names))
+
+
+def get_windows(filename, window_size):
+    """
+    Returns the breakpoints of windows of the specified size along the
+    tree sequence in the specified file, or None if window_size is None.
+    """
+    if window_size is None:
+        return None
+    sequence_length = load_columns(filename, ["sequence_length"])["sequence_length"][0]
+    windows = np.arange(0, sequence_length, window_size, dtype=np.float64)
+    return np.append(windows, sequence_length)
+
+
+def get_samples(columns):
+    return np.where(
+        (columns["node_flags"] & tskit.NODE_IS_SAMPLE) != 0)[0].astype(np.int32)
+
+
+def get_gnn_options(args):
+    """
+    Returns the compute_gnn keyword arguments for the specified command line
+    arguments. Per-window results are written alongside the output CSV.
+    """
+    return dict(
+        num_threads=args.num_threads,
+        windows=get_windows(args.input, args.window_size),
+        num_processes=args.num_processes,
+        windows_file=args.output + ".windows.npz")
+
+
+def write_gnn_csv(output, cols, partitions):
+    """
+    Writes the specified columns to the output CSV, except for the GNN
+    columns of the region partition. These are written along with the
+    non-GNN columns to a separate _region CSV, so that the main file keeps
+    one GNN column per population.
+    """
+    gnn_names = set()
+    for _, names in partitions.values():
+        gnn_names.update(names)
+    region_names = set(partitions["region"][1])
+    main_cols = collections.OrderedDict()
+    region_cols = collections.OrderedDict()
+    for name, value in cols.items():
+        if name not in region_names:
+            main_cols[name] = value
+        if name in region_names or name not in gnn_names:
+            region_cols[name] = value
+    pd.DataFrame(main_cols).to_csv(output)
+    root, ext = os.path.splitext(output)
+    pd.DataFrame(region_cols).to_csv(root + "_region" + ext)
 
-    for j, name in enumerate(population_names):
-        cols[name] = A[:, j]
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
 
+def run_compute_1kg_ukbb_gnn(args):
+    columns = load_metadata_columns(args.input)
+    samples = get_samples(columns)
+    partitions = collections.OrderedDict([
+        ("population", population_partition(columns)),
+        ("region", region_partition(columns, "super_population"))])
+
+    ind_metadata = columns["individuals"]
+    individual = columns["node_individual"][samples]
+    cols = {
+        "centre": ind_metadata["CentreName"][individual],
+        "sample_id": ind_metadata["SampleID"][individual],
+        "ethnicity": ind_metadata["Ethnicity"][individual],
+    }
+    cols.update(compute_gnn(
+        args.input, columns, samples, partitions, **get_gnn_options(args)))
+    write_gnn_csv(args.output, cols, partitions)
 
-def get_augmented_samples(tables):
-    # Shortcut. Iterating over all the IDs is very slow here.
-    # Note that we don't necessarily recover all of the samples that were 
-    # augmented here because they might have been simplified out.
-    # return np.load("ukbb_chr20.augmented_samples.npy")
-    nodes = tables.nodes
-    ids = np.where(nodes.flags == tsinfer.NODE_IS_SAMPLE_ANCESTOR)[0]
-    sample_ids = np.zeros(len(ids), dtype=int)
-    for j, node_id in enumerate(tqdm.tqdm(ids)):
-        offset = nodes.metadata_offset[node_id: node_id + 2]       
-        buff = bytearray(nodes.metadata[offset[0]: offset[1]])
-        md = json.loads(buff.decode())       
-        sample_ids[j] = md["sample"]
-    return sample_ids           
- 
 
 def run_compute_ukbb_gnn(args):
-    ts = tskit.load(args.input)
-    tables = ts.tables
     before = time.time()
-    augmented_samples = set(get_augmented_samples(tables))
+    columns = load_metadata_columns(args.input)
+    augmented_samples = get_augmented_samples(columns)
     duration = time.time() - before
     print("Got augmented:", len(augmented_samples), "in ", duration)
 
-    reference_sets_map = collections.defaultdict(list)
-     
-    ind_metadata = [None for _ in range(ts.num_individuals)]
-    all_samples = []
-    for ind in ts.individuals():
-        md = json.loads(ind.metadata.decode())
-        ind_metadata[ind.id] = md
-        for node in ind.nodes:
-            if node not in augmented_samples:
-                reference_sets_map[md["CentreName"]].append(node)
-                all_samples.append(node)
-    reference_set_names = list(reference_sets_map.keys())
-    reference_sets = [reference_sets_map[key] for key in reference_set_names]
-    
+    nodes, _ = get_individual_nodes(columns)
+    all_samples = nodes[~np.isin(nodes, augmented_samples)]
+    ind_metadata = columns["individuals"]
+    individual = columns["node_individual"][all_samples]
+    centre = ind_metadata["CentreName"][individual]
+    # Reference sets are in order of first appearance of each centre.
+    names, first, centre_index = np.unique(
+        centre, return_index=True, return_inverse=True)
+    rank = np.argsort(np.argsort(first))
+    labels = np.full(len(columns["node_flags"]), tskit.NULL, dtype=np.int32)
+    labels[all_samples] = rank[centre_index.reshape(-1)]
+    partitions = {"centre": (labels, names[np.argsort(first)])}
+
     cols = {
-        "centre": [
-            ind_metadata[ts.node(u).individual]["CentreName"] for u in all_samples],
-        "sample_id": [
-            ind_metadata[ts.node(u).individual]["SampleID"] for u in all_samples],
-        "ethnicity": [
-            ind_metadata[ts.node(u).individual]["Ethnicity"] for u in all_samples],
+        "centre": centre,
+        "sample_id": ind_metadata["SampleID"][individual],
+        "ethnicity": ind_metadata["Ethnicity"][individual],
     }
-    print("Computing GNNs for ", len(all_samples), "samples")
-    before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        all_samples, reference_sets, num_threads=args.num_threads)
-    duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
-
-    for j, name in enumerate(reference_set_names):
-        cols[name] = A[:, j]
+    cols.update(compute_gnn(
+        args.input, columns, all_samples, partitions, **get_gnn_options(args)))
     df = pd.DataFrame(cols)
     df.to_csv(args.output)
-     
- 
+
+
+def get_sample_populations(columns, samples, individual_key, region_key):
+    """
+    Returns the dict of individual, population and region columns for the
+    specified samples.
+    """
+    populations = columns["populations"]
+    node_population = columns["node_population"][samples]
+    individual = columns["node_individual"][samples]
+    return {
+        "population": populations["name"][node_population],
+        "region": populations[region_key][node_population],
+        "individual": columns["individuals"][individual_key][individual],
+    }
+
+
+def compute_population_gnn(args, individual_key, region_key):
+    """
+    Writes the GNN proportions of all samples by population and by region,
+    using the samples in each population as reference sets.
+    """
+    columns = load_metadata_columns(args.input)
+    samples = get_samples(columns)
+    is_sample = (columns["node_flags"] & tskit.NODE_IS_SAMPLE) != 0
+    partitions = collections.OrderedDict([
+        ("population", population_partition(columns, is_sample)),
+        ("region", region_partition(columns, region_key, is_sample))])
+    cols = compute_gnn(
+        args.input, columns, samples, partitions, **get_gnn_options(args))
+    cols.update(get_sample_populations(columns, samples, individual_key, region_key))
+    write_gnn_csv(args.output, cols, partitions)
+
+
 def run_compute_1kg_gnn(args):
-    ts = tskit.load(args.input)
+    compute_population_gnn(args, "individual_id", "super_population")
 
-    population_name = []
-    region_name = []
-
-    for population in ts.populations():
-        md = json.loads(population.metadata.decode())
-        name = md["name"]
-        population_name.append(name)    
-        region_name.append(md["super_population"])     
-
-    population = []
-    region = []
-    individual = []
-    for j, u in enumerate(ts.samples()):
-        node = ts.node(u)
-        ind = json.loads(ts.individual(node.individual).metadata.decode())
-        individual.append(ind["individual_id"])
-        population.append(population_name[node.population])
-        region.append(region_name[node.population])
-
-    sample_sets = [ts.samples(pop) for pop in range(ts.num_populations)]
-    print("Computing GNNs")
-    before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        ts.samples(), sample_sets, num_threads=args.num_threads)   
-    duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
 
-    cols = {population_name[j]: A[:, j] for j in range(ts.num_populations)}
-    cols["population"] = population
-    cols["region"] = region
-    cols["individual"] = individual
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
-   
- 
 def run_compute_sgdp_gnn(args):
-    ts = tskit.load(args.input)
+    compute_population_gnn(args, "sgdp_id", "region")
 
-    population_name = []
-    region_name = []
-
-    for population in ts.populations():
-        md = json.loads(population.metadata.decode())
-        name = md["name"]
-        population_name.append(name)    
-        region_name.append(md["region"])     
-
-    population = []
-    region = []
-    individual = []
-    for j, u in enumerate(ts.samples()):
-        node = ts.node(u)
-        ind = json.loads(ts.individual(node.individual).metadata.decode())
-        individual.append(ind["sgdp_id"])
-        population.append(population_name[node.population])
-        region.append(region_name[node.population])
-
-    sample_sets = [ts.samples(pop) for pop in range(ts.num_populations)]
-    print("Computing GNNs")
-    before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        ts.samples(), sample_sets, num_threads=args.num_threads)   
-    duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
-
-    cols = {population_name[j]: A[:, j] for j in range(ts.num_populations)}
-    cols["population"] = population
-    cols["region"] = region
-    cols["individual"] = individual
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
-   
 
 def run_snip_centromere(args):
     with open(args.centromeres) as csvfile:
@@ -461,6 +1097,10 @@ def main():
     subparser.add_argument(
         "--num-individuals", type=int, help="number of individuals to use",
         default=None)
+    subparser.add_argument(
+        "--chunk-size", type=int, default=None,
+        help="Number of UKBB sites to read genotypes for at a time. Defaults "
+             "to the chunk size of the samples file.")
     subparser.set_defaults(func=run_combine_ukbb_1kg)
 
     subparser = subparsers.add_parser("benchmark-tskit")
@@ -485,6 +1125,12 @@ def main():
     subparser.add_argument(
         "output", type=str, help="Filename to write CSV to.")
     subparser.add_argument("--num-threads", type=int, default=16)
+    subparser.add_argument(
+        "--window-size", type=float, default=None,
+        help="Compute the GNN in windows of this size and merge them")
+    subparser.add_argument(
+        "--num-processes", type=int, default=1,
+        help="Number of processes to compute windows in parallel")
     subparser.set_defaults(func=run_compute_1kg_ukbb_gnn)
      
     subparser = subparsers.add_parser("compute-ukbb-gnn")
@@ -493,6 +1139,12 @@ def main():
     subparser.add_argument(
         "output", type=str, help="Filename to write CSV to.")
     subparser.add_argument("--num-threads", type=int, default=16)
+    subparser.add_argument(
+        "--window-size", type=float, default=None,
+        help="Compute the GNN in windows of this size and merge them")
+    subparser.add_argument(
+        "--num-processes", type=int, default=1,
+        help="Number of processes to compute windows in parallel")
     subparser.set_defaults(func=run_compute_ukbb_gnn)
 
     subparser = subparsers.add_parser("compute-1kg-gnn")
@@ -501,6 +1153,12 @@ def main():
     subparser.add_argument(
         "output", type=str, help="Filename to write CSV to.")
     subparser.add_argument("--num-threads", type=int, default=16)
+    subparser.add_argument(
+        "--window-size", type=float, default=None,
+        help="Compute the GNN in windows of this size and merge them")
+    subparser.add_argument(
+        "--num-processes", type=int, default=1,
+        help="Number of processes to compute windows in parallel")
     subparser.set_defaults(func=run_compute_1kg_gnn)
 
     subparser = subparsers.add_parser("compute-sgdp-gnn")
@@ -509,6 +1167,12 @@ def main():
     subparser.add_argument(
         "output", type=str, help="Filename to write CSV to.")
     subparser.add_argument("--num-threads", type=int, default=16)
+    subparser.add_argument(
+        "--window-size", type=float, default=None,
+        help="Compute the GNN in windows of this size and merge them")
+    subparser.add_argument(
+        "--num-processes", type=int, default=1,
+        help="Number of processes to compute windows in parallel")
     subparser.set_defaults(func=run_compute_sgdp_gnn)
 
     subparser = subparsers.add_parser("snip-centromere")
@@ -4,8 +4,6 @@ data files used for plotting.
 """
 import argparse
 import os.path
-import json
-import collections
 
 import numpy as np
 import pandas as pd
@@ -17,197 +15,212 @@ import tqdm
 
 data_prefix = "human-data"
 
-def print_sample_edge_stats(ts):
+# Shared utilities for the human data tree sequences.
+sys.path.insert(1, os.path.join(sys.path[0], "..", data_prefix))
+import tsutil
+
+def print_sample_edge_stats(filename, edge_index):
     """ 
     Print out some basic stats about the sample edges in the specified tree 
-    sequence.
+    sequence file, using the specified edge index.
     """
-    tables = ts.tables
-    child_counts = np.bincount(tables.edges.child)
-    samples = ts.samples()
-    all_counts = child_counts[samples]
+    columns = tsutil.load_columns(filename, ["nodes/flags", "sequence_length"])
+    flags = columns["nodes/flags"]
+    samples = np.where((flags & tskit.NODE_IS_SAMPLE) != 0)[0]
+    all_counts = edge_index.num_edges(samples)
     print("mean sample count    = ", np.mean(all_counts))
 
-    index = tables.nodes.flags[tables.edges.child] == msprime.NODE_IS_SAMPLE
-    length = tables.edges.right[index]- tables.edges.left[index]
+    index = flags[edge_index.child] == tskit.NODE_IS_SAMPLE
+    length = edge_index.right[index]- edge_index.left[index]
     print("mean length          = ", np.mean(length))
     print("median length        = ", np.median(length))
 
-    n50 = np.zeros(ts.num_samples)
-    edges = tables.edges
-    child = edges.child
-    left = edges.left
-    right = edges.right
-    for j, sample in enumerate(samples):
-        index = child == sample
-        length = right[index]- left[index]
-        length = np.sort(length)[::-1]
-        cumulative = np.cumsum(length)
-        # N50 is the first length such that the cumulative sum up to that point
-        # is >= L / 2.
-        n50[j] = length[cumulative >= ts.sequence_length / 2][0]
+    n50 = edge_index.n50(samples, columns["sequence_length"][0])
     print("Average N50          = ", np.mean(n50))
 
 
-def get_sgdp_sample_edges():
-    filename = os.path.join(data_prefix, "sgdp_chr20.nosimplify.trees")
-
-    ts = tskit.load(filename)
-    print("SGDP")
-    print_sample_edge_stats(ts)
-    population_name = []
-    population_region = []
-    for pop in ts.populations():
-        md = json.loads(pop.metadata.decode())
-        population_name.append(md["name"])
-        population_region.append(md["region"])
-
-    tables = ts.tables
-    child_counts = np.bincount(tables.edges.child)
-    datasets = []
-    samples = []
-    strands = []
-    populations = []
-    regions = []
-    sample_edges = []
-    for ind in ts.individuals():
-        md = json.loads(ind.metadata.decode())
-        for j, node_id in enumerate(ind.nodes):
-            node = ts.node(node_id)
-            samples.append(md["sgdp_id"])
-            strands.append(j)
-            populations.append(population_name[node.population])
-            regions.append(population_region[node.population])
-            sample_edges.append(child_counts[node_id])
-            datasets.append("sgdp")
-
+def get_sample_edges(filename, dataset, individual_key, region_key):
+    """
+    Returns a data frame containing the number of sample edges for every
+    sample node in the specified tree sequence. Only the edge and node
+    columns are read from the file.
+    """
+    edge_index = tsutil.ChildEdgeIndex.load(filename)
+    print_sample_edge_stats(filename, edge_index)
+    columns = tsutil.load_metadata_columns(filename)
+    population_name = columns["populations"]["name"]
+    population_region = columns["populations"][region_key]
+
+    nodes, strands = tsutil.get_individual_nodes(columns)
+    population = columns["node_population"][nodes]
+    individual = columns["node_individual"][nodes]
     df = pd.DataFrame({
-        "dataset": datasets,
-        "sample": samples,
+        "dataset": dataset,
+        "sample": columns["individuals"][individual_key][individual],
         "strand": strands,
-        "population": populations,
-        "region": regions,
-        "sample_edges": sample_edges})
+        "population": population_name[population],
+        "region": population_region[population],
+        "sample_edges": edge_index.num_edges(nodes)})
     return df
 
 
+def get_sgdp_sample_edges():
+    filename = os.path.join(data_prefix, "sgdp_chr20.nosimplify.trees")
+    print("SGDP")
+    return get_sample_edges(filename, "sgdp", "sgdp_id", "region")
+
+
 def get_1kg_sample_edges():
     filename = os.path.join(data_prefix, "1kg_chr20.nosimplify.trees")
-
-    ts = tskit.load(filename)
     print("TGP")
-    print_sample_edge_stats(ts)
-    population_name = []
-    population_region = []
-    for pop in ts.populations():
-        md = json.loads(pop.metadata.decode())
-        population_name.append(md["name"])
-        population_region.append(md["super_population"])
-
-    tables = ts.tables
-    child_counts = np.bincount(tables.edges.child)
-    datasets = []
-    samples = []
-    strands = []
-    populations = []
-    regions = []
-    sample_edges = []
-    for ind in ts.individuals():
-        md = json.loads(ind.metadata.decode())
-        for j, node_id in enumerate(ind.nodes):
-            node = ts.node(node_id)
-            samples.append(md["individual_id"])
-            strands.append(j)
-            populations.append(population_name[node.population])
-            regions.append(population_region[node.population])
-            sample_edges.append(child_counts[node_id])
-            datasets.append("1kg")
+    return get_sample_edges(filename, "1kg", "individual_id", "super_population")
 
-    df = pd.DataFrame({
-        "dataset": datasets,
-        "sample": samples,
-        "strand": strands,
-        "population": populations,
-        "region": regions,
-        "sample_edges": sample_edges})
-    return df
+
+def local_gnn(ts, focal, reference_sets):
+    """
+    Returns the local GNN proportions of the specified focal nodes along the
+    genome as run-length compressed intervals, computed in a single pass over
+    the trees. The result is a tuple (index, left, right, A), where row j
+    of A gives the proportions for focal[index[j]] over [left[j], right[j]).
+    Intervals are sorted by focal node and then position, and the intervals
+    for each focal node cover the whole sequence. Where a focal node has no
+    nearest neighbours (e.g., in a snipped centromere) its row is all zeros.
+    """
+    focal = np.asarray(focal, dtype=np.int32)
+    K = len(reference_sets)
+    N = ts.num_nodes
+    reference_set_map = np.zeros(N, dtype=np.int32) - 1
+    for k, reference_set in enumerate(reference_sets):
+        reference_set = np.asarray(reference_set, dtype=np.int32)
+        if np.any(reference_set_map[reference_set] != -1) or (
+                len(np.unique(reference_set)) != len(reference_set)):
+            raise ValueError("Duplicate value in reference sets")
+        reference_set_map[reference_set] = k
+
+    # Node N is a sentinel standing for NULL, so that we can follow parent
+    # pointers for many nodes at once. Column K of count holds the total
+    # number of reference samples below each node.
+    parent = np.zeros(N + 1, dtype=np.int32) + N
+    count = np.zeros((N + 1, K + 1), dtype=np.int32)
+    for j in range(K):
+        count[reference_sets[j], j] = 1
+        count[reference_sets[j], K] = 1
+    sample_count = count[:, :K]
+    total_count = count[:, K]
+
+    def propagate(u, value):
+        # Add value[j] to u[j] and all of its ancestors, walking up all the
+        # paths together one level at a time.
+        while len(u) > 0:
+            np.add.at(count, u, value)
+            u = parent[u]
+            keep = u != N
+            u = u[keep]
+            value = value[keep]
+
+    # The edges inserted and removed at each tree boundary, as ranges in the
+    # edges sorted by left and right coordinate.
+    edges = ts.tables.edges
+    edge_parent = edges.parent
+    edge_child = edges.child
+    in_order = np.argsort(edges.left, kind="stable")
+    out_order = np.argsort(edges.right, kind="stable")
+    breakpoints = np.array(list(ts.breakpoints()))[:-1]
+    in_start = np.searchsorted(edges.left[in_order], breakpoints, side="left")
+    in_end = np.searchsorted(edges.left[in_order], breakpoints, side="right")
+    out_start = np.searchsorted(edges.right[out_order], breakpoints, side="left")
+    out_end = np.searchsorted(edges.right[out_order], breakpoints, side="right")
+
+    F = len(focal)
+    own = reference_set_map[focal]
+    has_own = np.where(own != -1)[0]
+    last_row = np.zeros((F, K))
+    last_left = np.zeros(F)
+    chunks = []
+
+    for t, left in enumerate(tqdm.tqdm(breakpoints)):
+        # Removing an edge takes the old count of its child away from the
+        # ancestors of its parent in the tree with all removed edges detached.
+        # Inserting an edge adds the count of its child in that forest to the
+        # ancestors of its parent in the new tree.
+        removed = out_order[out_start[t]: out_end[t]]
+        value = count[edge_child[removed]]
+        parent[edge_child[removed]] = N
+        propagate(edge_parent[removed], -value)
+        inserted = in_order[in_start[t]: in_end[t]]
+        value = count[edge_child[inserted]]
+        parent[edge_child[inserted]] = edge_parent[inserted]
+        propagate(edge_parent[inserted], value)
+
+        # Find the nearest ancestor of each focal node with more than one
+        # reference sample below it.
+        p = parent[focal]
+        total = total_count[p]
+        active = np.where((total <= 1) & (p != N))[0]
+        while len(active) > 0:
+            p[active] = parent[p[active]]
+            total[active] = total_count[p[active]]
+            active = active[(total[active] <= 1) & (p[active] != N)]
+        valid = p != N
+        row = sample_count[p].astype(np.float64)
+        row[has_own, own[has_own]] -= 1
+        scale = total - (own != -1)
+        row[valid] /= scale[valid, np.newaxis]
+        row[~valid] = 0
+
+        changed = np.any(row != last_row, axis=1)
+        emit = np.where(changed & (last_left < left))[0]
+        if len(emit) > 0:
+            chunks.append((emit, last_left[emit], left, last_row[emit]))
+        changed = np.where(changed)[0]
+        last_left[changed] = left
+        last_row[changed] = row[changed]
+
+    emit = np.arange(F)
+    chunks.append((emit, last_left, ts.sequence_length, last_row))
+
+    index = np.hstack([chunk[0] for chunk in chunks])
+    lefts = np.hstack([chunk[1] for chunk in chunks])
+    rights = np.hstack([
+        np.zeros(len(chunk[0])) + chunk[2] for chunk in chunks])
+    A = np.vstack([chunk[3] for chunk in chunks])
+    order = np.lexsort((lefts, index))
+    return index[order], lefts[order], rights[order], A[order]
 
 
 def process_hg01933_local_gnn():
     filename = os.path.join(data_prefix, "1kg_chr20.snipped.trees")
     ts = tskit.load(filename)
-    region_sample_set_map = collections.defaultdict(list)
-    for population in ts.populations():
-        md = json.loads(population.metadata.decode())
-        region = md["super_population"]
-        region_sample_set_map[region].extend(list(ts.samples(
-            population=population.id)))
-    regions = list(region_sample_set_map.keys())
-    region_sample_sets = [region_sample_set_map[k] for k in regions]
-
-    def local_gnn(ts, focal, reference_sets):
-        reference_set_map = np.zeros(ts.num_nodes, dtype=int) - 1
-        for k, reference_set in enumerate(reference_sets):
-            for u in reference_set:
-                if reference_set_map[u] != -1:
-                    raise ValueError("Duplicate value in reference sets")
-                reference_set_map[u] = k
-
-        K = len(reference_sets)
-        A = np.zeros((len(focal), ts.num_trees, K))
-        lefts = np.zeros(ts.num_trees, dtype=float)
-        rights = np.zeros(ts.num_trees, dtype=float)
-        parent = np.zeros(ts.num_nodes, dtype=int) - 1
-        sample_count = np.zeros((ts.num_nodes, K), dtype=int)
-
-        # Set the intitial conditions.
-        for j in range(K):
-            sample_count[reference_sets[j], j] = 1
-
-        for t, ((left, right),edges_out, edges_in) in enumerate(ts.edge_diffs()):
-            for edge in edges_out:
-                parent[edge.child] = -1
-                v = edge.parent
-                while v != -1:
-                    sample_count[v] -= sample_count[edge.child]
-                    v = parent[v]
-            for edge in edges_in:
-                parent[edge.child] = edge.parent
-                v = edge.parent
-                while v != -1:
-                    sample_count[v] += sample_count[edge.child]
-                    v = parent[v]
-
-            # Process this tree.
-            for j, u in enumerate(focal):
-                focal_reference_set = reference_set_map[u]
-                p = parent[u]
-                lefts[t] = left
-                rights[t] = right
-                while p != tskit.NULL:
-                    total = np.sum(sample_count[p])
-                    if total > 1:
-                        break
-                    p = parent[p]
-                if p != tskit.NULL:
-                    scale = 1 / (total - int(focal_reference_set != -1))
-                    for k, reference_set in enumerate(reference_sets):
-                        n = sample_count[p, k] - int(focal_reference_set == k)
-                        A[j, t, k] = n * scale
-        return (A, lefts, rights)
-
-    for ind in ts.individuals():
-        md = json.loads(ind.metadata.decode())
-        if md["individual_id"] == "HG01933":
-            for j, node in enumerate(ind.nodes):
-                A, left, right = local_gnn(ts, [node], region_sample_sets)
-                df = pd.DataFrame(data=A[0], columns=regions)
-                df["left"] = left
-                df["right"] = right
-                # Remove rows with no difference in GNN to next row
-                keep_rows = ~(df.iloc[:, 0:5].diff(axis=0) == 0).all(axis=1)
-                df = df[keep_rows]
-                df.to_csv("data/HG01933_local_gnn_{}.csv".format(j))
+    columns = tsutil.load_metadata_columns(filename)
+    population_name = columns["populations"]["name"]
+    population_region = columns["populations"]["super_population"]
+    regions, region_index = np.unique(population_region, return_inverse=True)
+    node_population = columns["node_population"]
+    samples = ts.samples()
+    region_sample_sets = [
+        samples[np.isin(node_population[samples], np.where(region_index == k)[0])]
+        for k in range(len(regions))]
+
+    # Compute the local GNN for all PEL samples in one pass.
+    pel = np.where(population_name == "PEL")[0][0]
+    focal = samples[node_population[samples] == pel]
+    index, left, right, A = local_gnn(ts, focal, region_sample_sets)
+    individual_id = columns["individuals"]["individual_id"]
+    node = focal[index]
+    df = pd.DataFrame(data=A, columns=regions)
+    df["left"] = left
+    df["right"] = right
+    df["node"] = node
+    df["individual"] = individual_id[columns["node_individual"][node]]
+    df.to_csv("data/PEL_local_gnn.csv")
+
+    ind = np.where(individual_id == "HG01933")[0][0]
+    nodes, strands = tsutil.get_individual_nodes(columns)
+    for j, u in zip(strands[columns["node_individual"][nodes] == ind],
+                    nodes[columns["node_individual"][nodes] == ind]):
+        df_node = df[df.node == u][list(regions) + ["left", "right"]]
+        df_node.reset_index(drop=True).to_csv(
+            "data/HG01933_local_gnn_{}.csv".format(j))
 
 
 def process_sample_edges():
@@ -227,31 +240,19 @@ def process_sample_edge_outliers():
     Runs the analysis for finding the sample edge outliers.
     """
     filename = os.path.join(data_prefix, "1kg_chr20.nosimplify.trees")
-    ts = tskit.load(filename)
+    columns = tsutil.load_metadata_columns(filename)
+    edge_index = tsutil.ChildEdgeIndex.load(filename)
 
-    # construct the dictionary mapping individual names to their metadata
-    tables = ts.tables
-    individual_name_map = {}
-    for individual in ts.individuals():    
-        metadata = json.loads(individual.metadata.decode())
-        name = metadata["individual_id"]
-        individual_name_map[name] = individual
+    # Pair up the two haplotypes of each individual.
+    nodes, strands = tsutil.get_individual_nodes(columns)
+    second = np.where(strands == 1)[0]
+    individual = columns["node_individual"][nodes[second]]
+    names = columns["individuals"]["individual_id"][individual]
 
     # construct a dictionary linking individual's names to their number of 
     # breakpoints within 100bp of each other
-    close_breakpoints = dict()
-    child = tables.edges.child
-    left = tables.edges.left
-
-    for key, individual in tqdm.tqdm(individual_name_map.items()):
-        index_0 = child == individual.nodes[0]
-        left_0 = left[index_0]
-        index_1 = child == individual.nodes[1]
-        left_1 = left[index_1]
-        close_100 = 0
-        for breakpoint in left_0:
-            close_100 += len(left_1[(left_1 >= breakpoint - 100) & (left_1 <= breakpoint + 100)])
-        close_breakpoints[key] = close_100
+    counts = edge_index.close_breakpoints(nodes[second - 1], nodes[second], 100)
+    close_breakpoints = dict(zip(names, counts))
 
     print("Average = ", np.mean(list(close_breakpoints.values())))
     for ind in ["NA20289", "HG02789"]:
@@ -297,12 +298,14 @@ def process_ukbb_ukbb_gnn():
 
 def process_ukbb_1kg_duplicates():
     source_file = os.path.join(data_prefix, "1kg_ukbb_chr20.nosimplify.trees")
-    ts = tskit.load(source_file)
+    edge_index = tsutil.ChildEdgeIndex.load(source_file)
+    columns = tsutil.load_columns(
+        source_file, ["nodes/flags", "nodes/individual", "sequence_length"])
     print("loaded")
-    tables = ts.tables
-    child_counts = np.bincount(tables.edges.child)
-    samples = ts.samples()
-    all_counts = child_counts[ts.samples()]
+    sequence_length = columns["sequence_length"][0]
+    node_individual = columns["nodes/individual"]
+    samples = np.where((columns["nodes/flags"] & tskit.NODE_IS_SAMPLE) != 0)[0]
+    all_counts = edge_index.num_edges(samples)
 
     # First find all samples with < 50 edges.
     candidates = samples[np.where(all_counts < 50)]
@@ -311,30 +314,22 @@ def process_ukbb_1kg_duplicates():
     c1 = candidates[np.where(candidates[:-1] == (candidates[1:] - 1))]
 
     print("Found", c1.shape[0], "matches")
-     
-    edge_child = tables.edges.child
-    edge_parent = tables.edges.parent
-    edge_left = tables.edges.left
-    edge_right = tables.edges.right
-
-    for c in c1:
-        node = ts.node(c)
-        ind = ts.individual(node.individual)
-        print("Individual", ind.id, ind.nodes)
-        for u in [c, c + 1]:
-            print("\tChild", u)
-            index = edge_child == u
-            p = edge_parent[index]
-            length = edge_right[index] - edge_left[index]
-            # Compute the total length covered by all the parents
-            counter = collections.Counter()
-            for parent, L in zip(p, length):
-                counter[parent] += L / ts.sequence_length
-
-            for parent, L in counter.most_common(2):
-                node = ts.node(parent)
-                print("\t\tparent=", parent, "ind=", node.individual, "len=", L)
-                if L > 0.9:
+
+    # Compute the total length covered by all the parents of each child
+    children = np.vstack([c1, c1 + 1]).T.reshape(-1)
+    group, parent, coverage = edge_index.parent_coverage(
+        children, sequence_length)
+    group_start = np.searchsorted(group, np.arange(len(children) + 1))
+
+    for j, c in enumerate(c1):
+        ind = node_individual[c]
+        print("Individual", ind, np.where(node_individual == ind)[0])
+        for k in [2 * j, 2 * j + 1]:
+            print("\tChild", children[k])
+            for row in range(group_start[k], min(group_start[k] + 2, group_start[k + 1])):
+                print("\t\tparent=", parent[row], "ind=", node_individual[parent[row]],
+                      "len=", coverage[row])
+                if coverage[row] > 0.9:
                     break
 
 def main():
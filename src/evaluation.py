@@ -1390,7 +1390,9 @@ class Dataset(object):
             mutations_after_simulation=True,
             treefile_prefix=sim_fn,
             seed=seed,
-            slimname=SLiM_executable)
+            slimname=SLiM_executable,
+            # Daemonic pool workers cannot start their own pool
+            num_processes=1 if multiprocessing.current_process().daemon else len(stop_freqs))
 
         expected_suffix = ".trees"
         for outfreq, fn in saved_files.items():
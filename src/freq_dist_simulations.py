@@ -2,7 +2,6 @@
 Script to produce the data for plot showing accuracy of frequency as a proxy
 for allele age (supplementary figure s1).
 """
-import random
 import itertools
 import logging
 import argparse
@@ -13,157 +12,132 @@ import numpy as np
 import tqdm
 
 import msprime
-import tsinfer
 
 
 error_matrix=pd.read_csv("data/EmpiricalErrorPlatinum1000G.csv")
+# The error matrix rows are in increasing order of frequency. Each row gives
+# the probabilities of observing 0, 1 or 2 derived alleles given the true
+# diploid genotype.
+error_freq = error_matrix["freq"].values
+error_probs = error_matrix[
+    ["p00", "p01", "p02", "p10", "p11", "p12", "p20", "p21", "p22"]].values.reshape(
+        -1, 3, 3)
 
-def make_errors_genotype_model(g, error_probs):
-    """
-    Given an empirically estimated error probability matrix, resample for a particular
-    variant. Determine variant frequency and true genotype (g0, g1, or g2),
-    then return observed genotype based on row in error_probs with nearest
-    frequency. Treat each pair of alleles as a diploid individual.
-    """
-    w = np.copy(g)
-
-    # Make diploid (iterate each pair of alleles)
-    genos = [(w[i], w[i+1]) for i in range(0, w.shape[0], 2)]
-
-    # Record the true genotypes
-    g0 = [i for i, x in enumerate(genos) if x == (0, 0)]
-    g1a = [i for i, x in enumerate(genos) if x == (1, 0)]
-    g1b = [i for i, x in enumerate(genos) if x == (0, 1)]
-    g2 = [i for i, x in enumerate(genos) if x == (1, 1)]
-
-    for idx in g0:
-        result = [(0, 0), (1, 0), (1, 1)][
-            np.random.choice(3, p=error_probs[['p00', 'p01', 'p02']].values[0])]
-        if result == (1, 0):
-            genos[idx] = [(0, 1), (1, 0)][np.random.choice(2)]
-        else:
-            genos[idx] = result
-    for idx in g1a:
-        genos[idx] = [(0, 0), (1, 0), (1, 1)][
-            np.random.choice(3, p=error_probs[['p10', 'p11', 'p12']].values[0])]
-    for idx in g1b:
-        genos[idx] = [(0, 0), (0, 1), (1, 1)][
-            np.random.choice(3, p=error_probs[['p10', 'p11', 'p12']].values[0])]
-    for idx in g2:
-        result = [(0, 0), (1, 0), (1, 1)][
-            np.random.choice(3, p=error_probs[['p20', 'p21', 'p22']].values[0])]
-        if result == (1, 0):
-            genos[idx] = [(0, 1), (1, 0)][np.random.choice(2)]
-        else:
-            genos[idx] = result
-
-    return np.array(sum(genos, ()))    
-    
 
-def generate_samples_empirical(ts):
+def closest_error_rows(frequency):
+    """
+    Returns the index of the row of the error matrix with the nearest
+    frequency to each of the specified frequencies.
+    """
+    right = np.clip(np.searchsorted(error_freq, frequency), 1, len(error_freq) - 1)
+    left = right - 1
+    use_left = frequency - error_freq[left] <= error_freq[right] - frequency
+    return np.where(use_left, left, right)
+
 
+def make_errors_genotype_matrix(G, rng):
     """
-    Generate a samples file from a simulated ts based on an empirically estimated error matrix
-    Reject any variants that result in a fixed column. 
+    Given a (sites x samples) haploid genotype matrix, return a copy with
+    errors resampled from the empirically estimated error probability matrix,
+    using the row with the nearest frequency for each variant. Treat each
+    pair of alleles as a diploid individual. Heterozygotes keep their phase,
+    and new heterozygotes are given a random phase.
     """
-    assert ts.num_sites != 0
-    sample_data = tsinfer.SampleData(sequence_length=ts.sequence_length)
-
-    for v in ts.variants():
-        #Record the allele frequency
-        m = v.genotypes.shape[0]
-        frequency = np.sum(v.genotypes) / m
-
-        #Find closest row in error matrix file
-        closest_freq = error_matrix.iloc[(error_matrix['freq']-frequency).abs().argsort()[:1]]
-
-        #make new genotypes with error
-        # Reject any columns that have no 1s or no zeros.
-        # Unless the original also has them, as occasionally we have
-        # some sims (e.g. under selection) where a variant is fixed
-        genotypes = make_errors_genotype_model(v.genotypes,closest_freq)
-        
-        sample_data.add_site(
-            position=v.site.position, alleles=v.alleles,
-            genotypes=genotypes)
-
-    sample_data.finalise()
-    return sample_data
-
-def generate_samples(ts):
+    num_sites, num_samples = G.shape
+    frequency = np.sum(G, axis=1) / num_samples
+    probs = error_probs[closest_error_rows(frequency)]
+    a = G[:, 0::2]
+    b = G[:, 1::2]
+    true = a + b
+    cumulative = np.cumsum(probs, axis=2)[np.arange(num_sites)[:, np.newaxis], true]
+    u = rng.random_sample(true.shape)
+    observed = np.sum(u[..., np.newaxis] >= cumulative[..., :2], axis=2)
+
+    het = observed == 1
+    first = np.where(true == 1, a, rng.randint(2, size=true.shape))
+    E = np.empty_like(G)
+    E[:, 0::2] = np.where(het, first, observed // 2)
+    E[:, 1::2] = np.where(het, 1 - first, observed // 2)
+    return E
+
+
+def concordance_counts(positions, ages, frequencies, n_bins, bin_size, rng,
+                       block_size=1024):
     """
-    Generate a samples file from a simulated ts
-    Samples may have bits flipped with a specified probability.
-    (reject any variants that result in a fixed column)
+    Returns the number of pairs of variants with different ages in each
+    distance bin, and for each of the specified arrays of variant frequencies
+    the number of those pairs in which the older variant has the higher
+    frequency. Pairs with equal frequencies agree with probability 1/2,
+    decided using the specified RandomState. Pairs are compared in blocks of
+    rows of the upper triangle of the pair matrix, so memory stays bounded.
     """
-
-    assert ts.num_sites != 0
-    
-    sample_data = tsinfer.SampleData(sequence_length=ts.sequence_length)
-    for v in ts.variants():
-        sample_data.add_site(
-            position=v.site.position, alleles=v.alleles,
-            genotypes=v.genotypes)
-
-    sample_data.finalise()
-    return sample_data
+    m = len(positions)
+    total = np.zeros(n_bins, dtype=int)
+    agree = [np.zeros(n_bins, dtype=int) for _ in frequencies]
+    ties = [np.zeros(n_bins, dtype=int) for _ in frequencies]
+    for start in range(0, m, block_size):
+        stop = min(start + block_size, m)
+        keep = np.arange(start, stop)[:, np.newaxis] < np.arange(m)
+        keep &= ages[start:stop, np.newaxis] != ages
+        distance = np.abs(positions[start:stop, np.newaxis] - positions)
+        bins = distance[keep].astype(int) // bin_size
+        total += np.bincount(bins, minlength=n_bins)
+        age_less = (ages[start:stop, np.newaxis] < ages)[keep]
+        for freq, agree_k, ties_k in zip(frequencies, agree, ties):
+            freq_diff = freq[start:stop, np.newaxis] - freq
+            tied = (freq_diff == 0)[keep]
+            concordant = ~tied & (age_less == (freq_diff < 0)[keep])
+            agree_k += np.bincount(bins[concordant], minlength=n_bins)
+            ties_k += np.bincount(bins[tied], minlength=n_bins)
+    for agree_k, ties_k in zip(agree, ties):
+        agree_k += rng.binomial(ties_k, 0.5)
+    return total, agree
 
 
 def run_comparisons(params):
     sample_size, Ne, length, rec_rate, mut_rate, n_bins, seed = params
     bin_size = length//n_bins
     assert bin_size == length/n_bins
-    total = np.zeros(n_bins, dtype=np.int)
-    agree = np.zeros(n_bins, dtype=np.int)
-    total_error = np.zeros(n_bins, dtype=np.int)
-    agree_error = np.zeros(n_bins, dtype=np.int)
 
     simulation = msprime.simulate(
         sample_size=sample_size, Ne=Ne, length=length, recombination_rate=rec_rate, 
         mutation_rate=mut_rate, random_seed=seed)
-    sample_data = generate_samples(simulation)
-    sample_data_error = generate_samples_empirical(simulation)
-    num_mutations = len(sample_data.sites_genotypes[:])
-    variant_ages = [(mutation.id,simulation.node(mutation.node).time) for mutation in list(simulation.mutations())]
-    variant_frequencies = [len(geno[geno==1])/len(geno) for geno in sample_data.sites_genotypes[:]]
-    variant_frequencies_error = [len(geno[geno==1])/len(geno) for geno in sample_data_error.sites_genotypes[:]]
-
-    mutation_positions=[mutation.position for mutation in list(simulation.mutations())]
-
-    for combo in list(itertools.combinations(range(0,num_mutations),2)):
-        age1 = variant_ages[combo[0]]
-        age2 = variant_ages[combo[1]]
-
-        freq1 = variant_frequencies[combo[0]]
-        freq2 = variant_frequencies[combo[1]]
-
-        freq1_error = variant_frequencies_error[combo[0]]
-        freq2_error = variant_frequencies_error[combo[1]]
-        
-        distance = int(abs(mutation_positions[combo[0]] - mutation_positions[combo[1]]))
-        
-        if (age1[1] != age2[1]):
-            total[distance//bin_size] += 1
-
-            if (freq1 != freq2):
-                if ((age1[1] < age2[1]) == (freq1 < freq2)):
-                    agree[distance//bin_size] += 1
-
-            else:
-                if (random.choice([True, False])):
-                    agree[distance//bin_size] += 1
-
-            if (freq1_error != freq2_error):
-                if ((age1[1] < age2[1]) == (freq1_error < freq2_error)):
-                    agree_error[distance//bin_size] += 1
-
-            else:
-                if (random.choice([True, False])):
-                    agree_error[distance//bin_size] += 1
-
+    assert simulation.num_sites != 0
+    tables = simulation.tables
+    variant_ages = tables.nodes.time[tables.mutations.node]
+    mutation_positions = tables.sites.position[tables.mutations.site]
+
+    rng = np.random.RandomState(seed)
+    genotypes = simulation.genotype_matrix()
+    genotypes_error = make_errors_genotype_matrix(genotypes, rng)
+    variant_frequencies = np.sum(genotypes, axis=1) / genotypes.shape[1]
+    variant_frequencies_error = (
+        np.sum(genotypes_error, axis=1) / genotypes_error.shape[1])
+
+    total, (agree, agree_error) = concordance_counts(
+        mutation_positions, variant_ages,
+        [variant_frequencies, variant_frequencies_error], n_bins, bin_size, rng)
     return total, agree, agree_error
 
 
+def run_comparison_chunk(params):
+    """
+    Runs the comparisons for each of the seeds in the specified chunk and
+    returns the number of replicates along with the summed counts, so that
+    only one reduction per chunk is sent back to the parent process.
+    """
+    sample_size, Ne, length, rec_rate, mut_rate, n_bins, seeds = params
+    total = np.zeros(n_bins, dtype=int)
+    agree = np.zeros(n_bins, dtype=int)
+    agree_error = np.zeros(n_bins, dtype=int)
+    for seed in seeds:
+        t, a, e = run_comparisons(
+            (sample_size, Ne, length, rec_rate, mut_rate, n_bins, seed))
+        total += t
+        agree += a
+        agree_error += e
+    return len(seeds), total, agree, agree_error
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
@@ -183,11 +157,17 @@ if __name__ == "__main__":
     parser.add_argument(
          '--progress',  "-P", action='store_true',
          help="Show a progress bar.")
+    parser.add_argument(
+        "--chunk-size", '-c', type=int, default=100,
+        help="number of replicates run by a worker in each task")
 
     args = parser.parse_args()
     
     np.random.seed(args.seed)
     random_seeds = np.random.randint(1 , 2**32, size = args.replicates)
+    seed_chunks = [
+        random_seeds[j: j + args.chunk_size]
+        for j in range(0, args.replicates, args.chunk_size)]
     run_params = zip(
         itertools.repeat(50),     # sample_size
         itertools.repeat(5000),   # Ne 
@@ -195,7 +175,7 @@ if __name__ == "__main__":
         itertools.repeat(1e-8), # recomb_rate
         itertools.repeat(1e-8), # mut_rate
         itertools.repeat(args.bins), # number of bins        
-        random_seeds # seed
+        seed_chunks # seeds
         )
     
     df = pd.DataFrame.from_dict({
@@ -205,24 +185,25 @@ if __name__ == "__main__":
         "Total":np.zeros(args.bins),
         "ErrorAgree":np.zeros(args.bins)})
     
-    if args.processes > 1:
-        logging.info("Setting up using multiprocessing ({} processes)".format(args.processes))
-        with multiprocessing.Pool(processes=args.processes, maxtasksperchild=2) as pool:
-            for total, agree, agree_error in tqdm.tqdm(
-                pool.imap_unordered(run_comparisons, run_params), total=args.replicates, disable=not args.progress):
-                df.Total += total
-                df.Agree += agree
-                df.ErrorAgree += agree_error
-                
-    else:
-        # When we have only one process it's easier to keep everything in the same
-        # process for debugging.
-        logging.info("Setting up using a single process")
-        for total, agree, agree_error in tqdm.tqdm(
-            map(run_comparisons, run_params), total=args.replicates, disable=not args.progress):
-            df.Total += total
-            df.Agree += agree
-            df.ErrorAgree += agree_error
+    def add_chunk(progress, result):
+        num_replicates, total, agree, agree_error = result
+        df.Total += total
+        df.Agree += agree
+        df.ErrorAgree += agree_error
+        progress.update(num_replicates)
+
+    with tqdm.tqdm(total=args.replicates, disable=not args.progress) as progress:
+        if args.processes > 1:
+            logging.info("Setting up using multiprocessing ({} processes)".format(args.processes))
+            with multiprocessing.Pool(processes=args.processes) as pool:
+                for result in pool.imap_unordered(run_comparison_chunk, run_params):
+                    add_chunk(progress, result)
+        else:
+            # When we have only one process it's easier to keep everything in the same
+            # process for debugging.
+            logging.info("Setting up using a single process")
+            for result in map(run_comparison_chunk, run_params):
+                add_chunk(progress, result)
 
     df.to_csv("data/frequency_distance_accuracy_singletons.csv")
 
@@ -82,23 +82,21 @@ def out_of_africa():
     )
 
 def main():
-    # simulate the length of chromosome 20 using out of africa model
+    # simulate the length of chromosome 20 using out of africa model. We only
+    # need the edges here, so there's no point in simulating mutations.
     length = 64444167
     ts = msprime.simulate(
-        **out_of_africa(), length=length, recombination_rate=2e-8, mutation_rate=2e-8,
+        **out_of_africa(), length=length, recombination_rate=2e-8,
         random_seed=12345)
 
-    population_name = ["African", "European", "Asian"]
+    population_name = np.array(["African", "European", "Asian"])
     tables = ts.tables
-    child_counts = np.bincount(tables.edges.child) 
+    child_counts = np.bincount(tables.edges.child, minlength=ts.num_nodes)
+    samples = ts.samples()
 
-    sample_edges = []
-    population = []
-    for u in ts.samples():
-        population.append(population_name[ts.node(u).population])
-        sample_edges.append(child_counts[u])
-
-    df = pd.DataFrame({"population": population, "sample_edges": sample_edges})
+    df = pd.DataFrame({
+        "population": population_name[tables.nodes.population[samples]],
+        "sample_edges": child_counts[samples]})
     df.to_csv("data/ooa_sample_edges_sim.csv")
 
 
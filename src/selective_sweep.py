@@ -1,8 +1,14 @@
 import subprocess
 import random
+import os
+import shutil
+import hashlib
+import tempfile
 import string
 import logging
 import argparse
+import json
+import multiprocessing
 
 import numpy as np
 
@@ -101,22 +107,112 @@ def comma_separated_list(arr):
     '''
     return "{}".format(arr)[1:-1]
 
+def output_label(o):
+    """
+    Return the part of the filename identifying the output at o, e.g. "0.5" for "0.5"
+    and "1.0+200" for ("1.0", 200)
+    """
+    is_tuple = isinstance(o, tuple)
+    label = o[0] if is_tuple else o
+    if is_tuple and len(o)>1 and o[1]:
+        label += "+%i" % o[1]
+    return label
+
+def run_slim(cmd, slimname):
+    process = subprocess.Popen(slimname,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
+        universal_newlines=True)
+    process.stdin.write(cmd)
+    process.stdin.close()
+    suppress_header_line = 3
+    for line in iter(process.stdout.readline, ''):
+        if suppress_header_line:
+            if suppress_header_line != 3:
+                suppress_header_line -= 1 #decrement
+            if line.startswith("// Starting run at generation"):
+                suppress_header_line = 2 #this is the penultimate line of the header
+        else:
+            logging.info(line.rstrip())
+    process.wait()
+    if process.returncode != 0:
+        raise RuntimeError("SLiM failed with status {}".format(process.returncode))
+
+def run_slim_cached(eidos_params, labels, cache_dir, slimname):
+    """
+    Run SLiM with the given Eidos parameters, unless the .decap files for all the
+    labels are already cached under the hash of the parameters. Return the prefix
+    of the cached .decap files.
+    """
+    # The key is the hash of the Eidos script itself, minus the output location
+    script = eidos_cmd.substitute(treefile_prefix="", **eidos_params)
+    key = hashlib.sha256(script.encode()).hexdigest()
+    decap_dir = os.path.join(cache_dir, key)
+    if all(os.path.exists(os.path.join(decap_dir, l + ".decap")) for l in labels):
+        logging.info("Using cached SLiM outputs in " + decap_dir)
+        return os.path.join(decap_dir, "")
+
+    # Write into a temporary directory so that an interrupted run is never cached
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=key + ".", suffix=".tmp")
+    try:
+        cmd = eidos_cmd.substitute(treefile_prefix=os.path.join(tmp_dir, ""), **eidos_params)
+        run_slim(cmd, slimname)
+        missing = [
+            l for l in labels if not os.path.exists(os.path.join(tmp_dir, l + ".decap"))]
+        if len(missing) > 0:
+            raise FileNotFoundError("SLiM did not save outputs for {}".format(missing))
+        try:
+            os.replace(tmp_dir, decap_dir)
+        except OSError:
+            # Another process has cached the same simulation in the meantime
+            if not all(os.path.exists(os.path.join(decap_dir, l + ".decap")) for l in labels):
+                raise
+            logging.info("Using SLiM outputs cached by another process in " + decap_dir)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    return os.path.join(decap_dir, "")
+
 def recapitate_mutate_simplify(ts, mu, rho, Ne, samples, seed):
     ts = ts.recapitate(recombination_rate=rho, Ne=Ne, random_seed=seed)
     subsamples = ts.samples()[samples]
     return msprime.mutate(ts, mu, random_seed=seed, keep=True).simplify(subsamples)
 
 
+def recapitate_output(params):
+    """
+    Load a SLiM .decap file, then recapitate, mutate and simplify it down to
+    nsamples diploids and save the result as a .trees file. All randomness,
+    including the choice of samples, comes from the given seed.
+    """
+    decap_fn, trees_fn, mu, rho, Ne, nsamples, seed = params
+    ts = pyslim.load(decap_fn) #no simplify
+    #pick a different N samples each time (the recapitation may be different anyway)
+    samp = np.random.RandomState(seed).choice(ts.num_samples, nsamples*2, replace=False)
+    ts = recapitate_mutate_simplify(ts, mu, rho, Ne, samp, seed)
+    ts.dump(trees_fn)
+    logging.info("Finished recapitating and mutating " + trees_fn)
+    return trees_fn
+
+
 def simulate_sweep(popsize, chrom_length, recomb_rate, mut_rate, 
     selection_coef, dominance_coef, nsamples, output_at_freqs, 
     mutations_after_simulation = True, equilibration_gens=100,
-    max_generations=1e9, treefile_prefix="sweepfile", seed=None, slimname="slim"):
+    max_generations=1e9, treefile_prefix="sweepfile", seed=None, slimname="slim",
+    num_processes=1, cache_dir=None):
     """
     Carry out a simulation of a selective sweep, and save msprime-format files at frequencies
     specified by output_at_freqs, which is a list of (frequency, post_generation) tuples
     Note that some of these files may have fixed variants (i.e. mutations above the root node)
     
     nsamples is number of *diploid* samples
+
+    The saved outputs are recapitated in num_processes processes, each with its own
+    seed drawn from seed. The seeds used are saved to treefile_prefix + "seeds.json"
+
+    If a seed is given, the SLiM .decap outputs are cached in cache_dir (by default
+    the slim_cache directory next to treefile_prefix), keyed by a hash of the Eidos
+    parameters, and a rerun with the same parameters goes straight to recapitation
     """
     freq_to_output = set()
     gens_post_fixation_to_output = set()
@@ -133,57 +229,61 @@ def simulate_sweep(popsize, chrom_length, recomb_rate, mut_rate,
             freq_to_output.add(freq)
 
     eidos_seed_cmd = "" if seed is None else "setSeed({});".format(int(seed))
-    cmd = eidos_cmd.substitute(
+    eidos_params = dict(
         set_random_seed_cmd = eidos_seed_cmd,
-        treefile_prefix = treefile_prefix,
         dominance_coefficient = dominance_coef,
         selection_coefficient = selection_coef,
         mutant_position = chrom_length//2,
         popsize = popsize,
         length = chrom_length,
         recombination_rate = recomb_rate,
-        freq_strings = comma_separated_list(freq_to_output),
-        output_gens  = comma_separated_list(gens_post_fixation_to_output),
+        # Sorted so that the parameters (and hence the cache key) are deterministic
+        freq_strings = comma_separated_list(sorted(freq_to_output)),
+        output_gens  = comma_separated_list(sorted(gens_post_fixation_to_output)),
         max_generations = int(max_generations),
         equilibration_gens = equilibration_gens
     )
+    labels = [output_label(o) for o in output_at_freqs]
+    if seed is None:
+        # An unseeded simulation can't be reproduced, so there is no point caching it
+        decap_prefix = treefile_prefix
+        run_slim(
+            eidos_cmd.substitute(treefile_prefix=treefile_prefix, **eidos_params),
+            slimname)
+    else:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(treefile_prefix), "slim_cache")
+        decap_prefix = run_slim_cached(eidos_params, labels, cache_dir, slimname)
 
-    process = subprocess.Popen(slimname,
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
-        universal_newlines=True)
-    process.stdin.write(cmd)
-    process.stdin.close()
-    suppress_header_line = 3
-    for line in iter(process.stdout.readline, ''):
-        if suppress_header_line:
-            if suppress_header_line != 3:
-                suppress_header_line -= 1 #decrement
-            if line.startswith("// Starting run at generation"):
-                suppress_header_line = 2 #this is the penultimate line of the header
-        else:
-            logging.info(line.rstrip())
-    ret_val = {}
-    for o in output_at_freqs:
-        is_tuple = isinstance(o, tuple)
-        freq = o[0] if is_tuple else o        
-        fn = treefile_prefix + freq
-        if is_tuple and len(o)>1 and o[1]:
-            fn += "+%i" % o[1]
-        #pick a different N samples each time (the recapitation may be different anyway)
-        ts = pyslim.load(fn + ".decap") #no simplify
-        samp = np.random.choice(ts.num_samples, nsamples*2, replace=False)
-        ts = recapitate_mutate_simplify(ts, mut_rate, recomb_rate, popsize, samp, seed)
-        fn += ".trees"
-        ts.dump(fn)
-        ret_val[o] = fn
-        logging.info("Finished recapitating and mutating " + fn)
-    return ret_val
+    rng = np.random.RandomState(seed)
+    work = []
+    recapitation_seeds = {}
+    for label in labels:
+        trees_fn = treefile_prefix + label + ".trees"
+        output_seed = int(rng.randint(1, 2**31))
+        recapitation_seeds[trees_fn] = output_seed
+        work.append((
+            decap_prefix + label + ".decap", trees_fn, mut_rate, recomb_rate, popsize,
+            nsamples, output_seed))
+    with open(treefile_prefix + "seeds.json", "w") as f:
+        json.dump({
+            "seed": seed, "decap_prefix": decap_prefix,
+            "recapitation_seeds": recapitation_seeds}, f)
+
+    if num_processes > 1:
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            trees_files = pool.map(recapitate_output, work)
+    else:
+        trees_files = list(map(recapitate_output, work))
+    return dict(zip(output_at_freqs, trees_files))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run a simulation with a selective sweep.")
     parser.add_argument("--seed", "-s", type=int, help="run a single simulation with this seed")
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                     action="store_true")
+    parser.add_argument("--processes", "-p", type=int, default=6,
+                    help="number of processes used to recapitate the saved outputs")
 
     args = parser.parse_args()
     if args.verbose:
@@ -196,4 +296,5 @@ if __name__ == '__main__':
         simulate_sweep(
             5000, 100000, 1e-8, 0.000000132288, 0.1, 0.5, 16,  
             output_at_freqs=['0.2', '0.5', '0.8', '1.0', ('1.0', 200), ('1.0', 1000)], 
-            seed = seed, treefile_prefix="sim{}_".format(seed), slimname="./tools/SLiM/build/slim")
\ No newline at end of file
+            seed = seed, treefile_prefix="sim{}_".format(seed), slimname="./tools/SLiM/build/slim",
+            num_processes=args.processes)
\ No newline at end of file
@@ -10,6 +10,9 @@ import subprocess
 import io
 import concurrent.futures
 import sys
+import resource
+import json
+import platform
 
 import numpy as np
 import msprime
@@ -22,6 +25,14 @@ import cyvcf2
 # Used for newick
 from Bio import Phylo
 
+try:
+    # Local module in the human-data directory, only needed for the BGEN
+    # benchmark.
+    sys.path.insert(1, os.path.join(sys.path[0], "..", "human-data"))
+    import simplebgen
+except ImportError:
+    simplebgen = None
+
 datafile = "data/storing_everyone.csv"
 data_prefix = "data/raw__NOBACKUP__/storing_everyone"
 mutation_rate = 1e-8
@@ -34,6 +45,10 @@ if not os.path.exists(data_prefix):
 
 
 def run_simulation(sample_size):
+    """
+    Simulates the specified sample size and writes the .trees file. Returns
+    the time taken and the peak RSS of the process in bytes.
+    """
     before = time.perf_counter()
     ts = msprime.simulate(
         sample_size=sample_size, Ne=Ne, mutation_rate=mutation_rate,
@@ -41,13 +56,189 @@ def run_simulation(sample_size):
     duration = time.perf_counter() - before
     print("Simulated {} in {} hours".format(sample_size, duration / 3600))
     trees_file = os.path.join(data_prefix, "{}.trees".format(sample_size))
-    ts.dump(trees_file)
-    subprocess.check_call(["gzip", "-k", trees_file])
+    tmp_file = "{}.{}.tmp".format(trees_file, os.getpid())
+    ts.dump(tmp_file)
+    os.replace(tmp_file, trees_file)
+    # ru_maxrss is in KiB on Linux.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return duration, max_rss
+
+
+def estimate_memory(sample_size, smaller_size, memory):
+    """
+    Returns the estimated peak RSS for simulating the specified sample size,
+    given the dict of measured peak RSS for other sample sizes, or None if
+    it is unknown. A previous measurement of the size itself is used if
+    there is one. Otherwise the next-smaller size in the series must have
+    been measured, and we fit a power law through it and the largest
+    measured size below it.
+    """
+    if sample_size in memory:
+        return memory[sample_size]
+    if smaller_size not in memory:
+        return None
+    smaller = sorted(n for n in memory if n < smaller_size)
+    exponent = 1
+    if len(smaller) > 0:
+        n1 = smaller[-1]
+        exponent = max(
+            np.log(memory[smaller_size] / memory[n1]) / np.log(smaller_size / n1), 0)
+    return memory[smaller_size] * (sample_size / smaller_size)**exponent
+
+
+def start_gzip(filename):
+    """
+    Starts compressing the specified file in the background, keeping the
+    original. Returns the tuple to pass to finish_gzip.
+    """
+    tmp_file = filename + ".gz.tmp"
+    with open(tmp_file, "wb") as f:
+        proc = subprocess.Popen(["gzip", "-c", filename], stdout=f)
+    return proc, tmp_file, filename + ".gz"
+
+
+def finish_gzip(gzip_job):
+    proc, tmp_file, gz_file = gzip_job
+    if proc.wait() != 0:
+        raise ValueError("gzip failed for {}".format(gz_file))
+    os.replace(tmp_file, gz_file)
 
 
 def run_simulate(args):
-    for k in range(1, 8):
-        run_simulation(10**k)
+    """
+    Simulates the sample sizes 10^1 to 10^7, running as many concurrently as
+    fit in the memory budget and skipping those already simulated. Each
+    simulation runs in a fresh process so that its peak RSS can be measured,
+    and the peak RSS of completed sizes is used to estimate the memory
+    needed for larger ones. A size whose memory is unknown is only run on
+    its own, so on a fresh run each size waits for the next-smaller one to
+    report its peak RSS. Gzipping each output overlaps with the following
+    simulations.
+    """
+    stats_file = os.path.join(data_prefix, "simulate.csv")
+    memory = {}
+    rows = []
+    if os.path.exists(stats_file):
+        df = pd.read_csv(stats_file)
+        rows = df.to_dict("records")
+        memory = dict(zip(df.sample_size, df.max_rss))
+    budget = args.memory_budget * 1024**3
+
+    gzip_jobs = []
+    pending = []
+    sizes = [10**k for k in range(1, 8)]
+    smaller_size = dict(zip(sizes[1:], sizes[:-1]))
+    for n in sizes:
+        trees_file = os.path.join(data_prefix, "{}.trees".format(n))
+        if os.path.exists(trees_file):
+            print("Skipping", n, "as", trees_file, "exists")
+            if not os.path.exists(trees_file + ".gz"):
+                gzip_jobs.append(start_gzip(trees_file))
+        else:
+            pending.append(n)
+
+    running = {}
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < args.num_processes:
+            n = pending[0]
+            estimate = estimate_memory(n, smaller_size.get(n), memory)
+            if len(running) > 0:
+                # Nothing else may run alongside a size of unknown memory.
+                if estimate is None or any(
+                        e is None for _, e, _ in running.values()):
+                    break
+                in_use = sum(e for _, e, _ in running.values())
+                if in_use + estimate > budget:
+                    break
+            if estimate is not None and estimate > budget:
+                print("WARNING: estimated memory for {} of {} exceeds budget".format(
+                    n, humanize.naturalsize(estimate, binary=True)))
+            pending.pop(0)
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+            future = executor.submit(run_simulation, n)
+            running[future] = (n, estimate, executor)
+            print("Started", n, "with estimated memory", "unknown"
+                  if estimate is None else humanize.naturalsize(estimate, binary=True))
+
+        done, _ = concurrent.futures.wait(
+            running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            n, _, executor = running.pop(future)
+            executor.shutdown()
+            duration, max_rss = future.result()
+            memory[n] = max_rss
+            rows.append({"sample_size": n, "duration": duration, "max_rss": max_rss})
+            pd.DataFrame(rows).to_csv(stats_file, index=False)
+            print("Finished", n, "using",
+                  humanize.naturalsize(max_rss, binary=True))
+            gzip_jobs.append(
+                start_gzip(os.path.join(data_prefix, "{}.trees".format(n))))
+
+    for gzip_job in gzip_jobs:
+        finish_gzip(gzip_job)
+
+
+def ragged_slice(data, offset, start, stop):
+    """
+    Returns the (data, offset) columns for rows start to stop of the
+    specified ragged column.
+    """
+    return (
+        data[offset[start]: offset[stop]],
+        offset[start: stop + 1] - offset[start])
+
+
+def subset_sites(tables, start, stop):
+    """
+    Subsets the sites in the specified tables in place to the site IDs from
+    start to stop, along with their mutations, by slicing the columns.
+    """
+    sites = tables.sites
+    mutations = tables.mutations
+    stop = min(stop, sites.num_rows)
+    mut_start, mut_stop = np.searchsorted(mutations.site, [start, stop])
+
+    position = sites.position[start: stop]
+    ancestral_state, ancestral_state_offset = ragged_slice(
+        sites.ancestral_state, sites.ancestral_state_offset, start, stop)
+    metadata, metadata_offset = ragged_slice(
+        sites.metadata, sites.metadata_offset, start, stop)
+    sites.set_columns(
+        position=position, ancestral_state=ancestral_state,
+        ancestral_state_offset=ancestral_state_offset, metadata=metadata,
+        metadata_offset=metadata_offset)
+
+    # Mutation parents are always at the same site, so they stay in range.
+    parent = mutations.parent[mut_start: mut_stop]
+    parent = np.where(parent == tskit.NULL, parent, parent - mut_start)
+    derived_state, derived_state_offset = ragged_slice(
+        mutations.derived_state, mutations.derived_state_offset, mut_start,
+        mut_stop)
+    metadata, metadata_offset = ragged_slice(
+        mutations.metadata, mutations.metadata_offset, mut_start, mut_stop)
+    mutations.set_columns(
+        site=mutations.site[mut_start: mut_stop] - start,
+        node=mutations.node[mut_start: mut_stop], parent=parent.astype(np.int32),
+        derived_state=derived_state, derived_state_offset=derived_state_offset,
+        metadata=metadata, metadata_offset=metadata_offset)
+
+
+def write_subset_bcf(ts, num_sites, vcf_filename, bcf_filename):
+    """
+    Writes the first num_sites sites of the specified tree sequence to the
+    specified VCF and BCF files.
+    """
+    tables = ts.dump_tables()
+    subset_sites(tables, 0, num_sites)
+    ts = tables.tree_sequence()
+    print("Subsetted tree sequence")
+
+    with open(vcf_filename, "w") as vcf_file:
+        ts.write_vcf(vcf_file, 2)
+    print("Wrote ", vcf_filename)
+    subprocess.check_call(["bcftools view -O b {} > {}".format(
+        vcf_filename, bcf_filename)], shell=True)
+    print("Wrote ", bcf_filename)
 
 
 def benchmark_bcf(ts):
@@ -56,30 +247,7 @@ def benchmark_bcf(ts):
     vcf_filename = os.path.join(data_prefix, "large-subset.vcf")
     bcf_filename = os.path.join(data_prefix, "large-subset.bcf")
     if not os.path.exists(vcf_filename):
-
-        tables = ts.dump_tables()
-        tables.sites.clear()
-        tables.mutations.clear()
-        for site in ts.sites():
-            if site.id == num_sites:
-                break
-            site_id = tables.sites.add_row(
-                site.position, ancestral_state=site.ancestral_state,
-                metadata=site.metadata)
-            for mutation in site.mutations:
-                tables.mutations.add_row(
-                    site_id, node=mutation.node, parent=mutation.parent,
-                    derived_state=mutation.derived_state,
-                    metadata=mutation.metadata)
-        ts = tables.tree_sequence()
-        print("Subsetted tree sequence")
-
-        with open(vcf_filename, "w") as vcf_file:
-            ts.write_vcf(vcf_file, 2)
-        print("Wrote ", vcf_filename)
-        subprocess.check_call(["bcftools view -O b {} > {}".format(
-            vcf_filename, bcf_filename)], shell=True)
-        print("Wrote ", bcf_filename)
+        write_subset_bcf(ts, num_sites, vcf_filename, bcf_filename)
 
     before = time.perf_counter()
     records = cyvcf2.VCF(bcf_filename)
@@ -98,8 +266,13 @@ def benchmark_bcf(ts):
         total_sites, estimated_time / 3600))
 
 
-def run_benchmark_newick(ts, num_trees):
-
+def time_newick(ts, num_trees):
+    """
+    Returns the total length of the Newick strings for the first num_trees
+    trees and the total time taken to parse them.
+    """
+    if num_trees > ts.num_trees:
+        raise ValueError("not enough trees!")
     total_length = 0
     total_duration = 0
     for tree in ts.trees():
@@ -111,9 +284,12 @@ def run_benchmark_newick(ts, num_trees):
         Phylo.read(handle, "newick")
         total_duration += time.perf_counter() - before
         total_length += len(ns)
-    else:
-        raise ValueError("not enough trees!")
+    return total_length, total_duration
+
+
+def run_benchmark_newick(ts, num_trees):
 
+    total_length, total_duration = time_newick(ts, num_trees)
     expected_size = (total_length / num_trees) * ts.num_trees
     mean_time = total_duration / num_trees
     print("Expected size of newick file: {:.2f}TiB".format(expected_size / 1024**6))
@@ -154,10 +330,59 @@ def run_benchmark(args):
     duration = time.perf_counter() - before
     print("Computed {} allele frequencies in {:.2f}s".format(ts.num_sites, duration))
 
+    # Compute the same frequencies for all sites at once using the sample set
+    # statistics. The summary function is the derived allele count, so
+    # polarising drops the ancestral allele.
+    before = time.perf_counter()
+    counts = ts.sample_count_stat(
+        [samples], lambda x: x, 1, windows="sites", mode="site",
+        polarised=True, span_normalise=False, strict=False)
+    stat_freq = counts[:, 0]
+    stat_duration = time.perf_counter() - before
+    assert np.array_equal(freq, stat_freq)
+    print("Computed {} allele frequencies using sample_count_stat in {:.2f}s "
+          "({:.1f}x faster)".format(
+              ts.num_sites, stat_duration, duration / stat_duration))
+
     benchmark_bcf(ts)
 
 
-def convert_file_worker(k):
+class TeeWriter(object):
+    """
+    Text file-like object that writes everything written to it to each of
+    the specified binary streams, counting the total number of bytes.
+    """
+    def __init__(self, streams):
+        self.streams = streams
+        self.num_bytes = 0
+
+    def write(self, s):
+        data = s.encode()
+        self.num_bytes += len(data)
+        for stream in self.streams:
+            stream.write(data)
+        return len(s)
+
+
+def close_streams(streams):
+    """
+    Closes the specified streams, ignoring pipes whose reader has exited.
+    """
+    for stream in streams:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def wait_all(procs):
+    for name, proc in procs:
+        proc.wait()
+        if proc.returncode != 0:
+            raise RuntimeError("{} failed with status: {}".format(name, proc.returncode))
+
+
+def convert_file_worker(k, keep_vcf=False):
     n = 10**k
     filename = os.path.join(data_prefix, "{}.trees".format(n))
     if not os.path.exists(filename):
@@ -167,39 +392,61 @@ def convert_file_worker(k):
     tsz_filename = filename + ".tsz"
     tszip.compress(ts, tsz_filename, variants_only=True)
 
-    # Convert to PBWT by piping in VCF. This avoids having the write the
-    # ~10TB VCF to disk.
     pbwt_filename = os.path.join(data_prefix, "{}.pbwt".format(n))
     pbwtgz_filename = pbwt_filename + ".gz"
     sites_filename = os.path.join(data_prefix, "{}.sites".format(n))
     sitesgz_filename = sites_filename + ".gz"
+    vcf_filename = os.path.join(data_prefix, "{}.vcf".format(n))
+    gz_filename = vcf_filename + ".gz"
 
+    # Generate the VCF once and tee it to PBWT, gzip and a byte counter, so
+    # that we never need to have the ~10TB VCF on disk. PBWT and gzip run in
+    # their own processes, so they work on the stream in parallel.
+    buffer_size = 2**20
     cmd = "./tools/pbwt/pbwt -readVcfGT - -write {} -writeSites {}".format(
         pbwt_filename, sites_filename)
-    read_fd, write_fd = os.pipe()
-    write_pipe = os.fdopen(write_fd, "w")
-    proc = subprocess.Popen(cmd, shell=True, stdin=read_fd)
-    ts.write_vcf(write_pipe, ploidy=2)
-    write_pipe.close()
-    os.close(read_fd)
-    proc.wait()
-    if proc.returncode != 0:
-        raise RuntimeError("pbwt failed with status:", proc.returncode)
-
-    subprocess.check_call(
-        "gzip -c {} > {}".format(pbwt_filename, pbwtgz_filename), shell=True)
-
-    subprocess.check_call(
-        "gzip -c {} > {}".format(sites_filename, sitesgz_filename), shell=True)
-
+    procs = [("pbwt", subprocess.Popen(
+        cmd, shell=True, stdin=subprocess.PIPE, bufsize=buffer_size))]
     if k < 7:
-        vcf_filename = os.path.join(data_prefix, "{}.vcf".format(n))
-        with open(vcf_filename, "w") as vcf_file:
-            ts.write_vcf(vcf_file, 2)
-        print("Wrote ", vcf_filename)
-        gz_filename = vcf_filename + ".gz"
-        subprocess.check_call("gzip -c {} > {}".format(vcf_filename, gz_filename), shell=True)
-        print("Wrote ", gz_filename)
+        procs.append(("gzip", subprocess.Popen(
+            "gzip -c > {}".format(gz_filename), shell=True,
+            stdin=subprocess.PIPE, bufsize=buffer_size)))
+    streams = [proc.stdin for _, proc in procs]
+    if keep_vcf:
+        streams.append(open(vcf_filename, "wb", buffering=buffer_size))
+    tee = TeeWriter(streams)
+    broken_pipe = None
+    try:
+        try:
+            ts.write_vcf(tee, ploidy=2)
+        except BrokenPipeError as e:
+            # One of the children exited mid-stream; report its exit status
+            # rather than the broken pipe if it failed.
+            broken_pipe = e
+        finally:
+            close_streams(streams)
+            for _, proc in procs:
+                proc.wait()
+        wait_all(procs)
+        if broken_pipe is not None:
+            raise broken_pipe
+    except BaseException:
+        for partial in [pbwt_filename, sites_filename, gz_filename, vcf_filename]:
+            if os.path.exists(partial):
+                os.unlink(partial)
+        raise
+    print("Wrote {} VCF bytes for n = {}".format(tee.num_bytes, n))
+    if k < 7:
+        # We only record VCF sizes where we used to write the full VCF, so
+        # that the VCF fits in make-data use the same points as before.
+        with open(vcf_filename + ".size", "w") as size_file:
+            print(tee.num_bytes, file=size_file)
+
+    wait_all([
+        ("gzip", subprocess.Popen(
+            "gzip -c {} > {}".format(source, dest), shell=True))
+        for source, dest in [
+            (pbwt_filename, pbwtgz_filename), (sites_filename, sitesgz_filename)]])
     return k
 
 
@@ -208,7 +455,8 @@ def run_convert_files(args):
     # for k in work:
     #     convert_file_worker(k)
     with concurrent.futures.ProcessPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(convert_file_worker, k) for k in work]
+        futures = [
+            executor.submit(convert_file_worker, k, args.keep_vcf) for k in work]
         for future in futures:
             print(future.result(), "done!")
 
@@ -233,6 +481,12 @@ def run_make_data(args):
         for array, filename in files:
             if os.path.exists(filename):
                 array[j] = os.path.getsize(filename) / GB
+        # The uncompressed VCF size is recorded by convert-files if the VCF
+        # itself wasn't kept.
+        vcf_size_file = os.path.join(data_prefix, "{}.vcf.size".format(n))
+        if vcf[j] == 0 and os.path.exists(vcf_size_file):
+            with open(vcf_size_file) as f:
+                vcf[j] = int(f.read()) / GB
         pbwt_file = os.path.join(data_prefix, "{}.pbwt".format(n))
         sites_file = os.path.join(data_prefix, "{}.sites".format(n))
         pbwtz_file = os.path.join(data_prefix, "{}.pbwt.gz".format(n))
@@ -293,26 +547,43 @@ def run_make_data(args):
     df.to_csv(datafile)
 
 
-def ts_to_minified(ts, filename):
+def minified_compressor():
+    import numcodecs
+    return numcodecs.Blosc(cname='zstd', clevel=9, shuffle=numcodecs.Blosc.SHUFFLE)
+
+
+def delta_filters(dtype):
+    import numcodecs
+    return [numcodecs.Delta(dtype=dtype)]
+
+
+def ts_to_minified(ts, filename, num_blocks=None, chunk_size=2**16):
     """
-    Returns a representation of the specified tree sequence that's optimised
-    to use the minimal amount of storage space. No metadata is stored,
-    and ancestal and derived states must be single characters.
+    Writes a representation of the specified tree sequence to the specified
+    file that's optimised to use the minimal amount of storage space. No
+    metadata is stored, and ancestal and derived states must be single
+    characters.
+
+    The genome is split into num_blocks blocks and edges spanning several
+    blocks are split at the block boundaries, so that the edges for a given
+    interval can be read without decompressing the rest of the file. By
+    default, the number of blocks is chosen so that splitting adds about 10%
+    to the number of edges.
     """
+    import zarr
+
     # First reduce to site topology
     ts = ts.simplify(reduce_to_site_topology=True)
     tables = ts.tables
-
-    store = zarr.ZipStore(filename, mode='w')
-    root = zarr.group(store=store)
-    nodes = root.create_group("nodes")
-    flags = nodes.empty("flags", shape=ts.num_nodes, dtype=np.uint8)
-    flags[:] = tables.nodes.flags
-    # print(flags.info)
+    for name, offset in [
+            ("ancestral", tables.sites.ancestral_state_offset),
+            ("derived", tables.mutations.derived_state_offset)]:
+        if np.any(np.diff(offset) != 1):
+            raise ValueError("{} states must be single characters".format(name))
 
     # Get the indexes into the position array.
-    pos_map = np.hstack([tables.sites.position, [tables.sequence_length]])
-    pos_map[0] = 0
+    position = tables.sites.position
+    pos_map = get_position_map(position, tables.sequence_length)
     left_mapped = np.searchsorted(pos_map, tables.edges.left)
     if np.any(pos_map[left_mapped] != tables.edges.left):
         raise ValueError("Invalid left coordinates")
@@ -320,40 +591,440 @@ def ts_to_minified(ts, filename):
     if np.any(pos_map[right_mapped] != tables.edges.right):
         raise ValueError("Invalid right coordinates")
 
-    filters = [numcodecs.Delta(dtype=np.int32, astype=np.int32)]
-    compressor = numcodecs.Blosc(cname='zstd', clevel=9, shuffle=numcodecs.Blosc.SHUFFLE)
+    # Split the edges into blocks of the mapped coordinates. Within a block
+    # edges stay in the input order, which keeps parent deltas small.
+    num_coords = len(pos_map) - 1
+    if num_blocks is None:
+        midpoint = num_coords // 2
+        spanning = np.sum((left_mapped <= midpoint) & (right_mapped > midpoint))
+        num_blocks = int(0.1 * ts.num_edges / max(spanning, 1))
+    num_blocks = max(1, min(num_blocks, num_coords))
+    block_size = -(-num_coords // num_blocks)
+    num_blocks = -(-num_coords // block_size)
+    first = left_mapped // block_size
+    count = (right_mapped - 1) // block_size - first + 1
+    piece = np.repeat(np.arange(ts.num_edges), count)
+    block = first[piece] + np.arange(len(piece)) - np.repeat(
+        np.cumsum(count) - count, count)
+    order = np.argsort(block, kind="stable")
+    piece = piece[order]
+    block = block[order]
+
+    # Entries in a zip file can't be overwritten, so the attributes are set
+    # once when creating the root group. We use the zarr v2 format, which
+    # supports the numcodecs filters and compressors directly.
+    store = zarr.storage.ZipStore(filename, mode='w')
+    root = zarr.create_group(store=store, zarr_format=2, attributes={
+        "format_name": "minified",
+        "format_version": 1,
+        "sequence_length": tables.sequence_length,
+        "block_size": int(block_size)})
+    compressor = minified_compressor()
+
+    nodes = root.create_group("nodes")
+    flags_dtype = np.uint8 if np.all(tables.nodes.flags < 256) else np.uint32
+    flags = nodes.create_array(
+        "flags", shape=ts.num_nodes, dtype=flags_dtype, chunks=chunk_size,
+        compressors=compressor)
+    flags[:] = tables.nodes.flags
+    node_time = nodes.create_array(
+        "time", shape=ts.num_nodes, dtype=np.float64, chunks=chunk_size,
+        compressors=compressor)
+    node_time[:] = tables.nodes.time
+
+    sites = root.create_group("sites")
+    # Integer positions are delta encoded, which doesn't round-trip exactly
+    # for floating point values.
+    if np.all(position == np.round(position)):
+        stored_position = sites.create_array(
+            "position", shape=ts.num_sites, dtype=np.int64, chunks=chunk_size,
+            filters=delta_filters(np.int64), compressors=compressor)
+    else:
+        stored_position = sites.create_array(
+            "position", shape=ts.num_sites, dtype=np.float64, chunks=chunk_size,
+            compressors=compressor)
+    stored_position[:] = position
+    ancestral_state = sites.create_array(
+        "ancestral_state", shape=ts.num_sites, dtype=np.uint8, chunks=chunk_size,
+        compressors=compressor)
+    ancestral_state[:] = tables.sites.ancestral_state
+    mutation_offset = sites.create_array(
+        "mutation_offset", shape=ts.num_sites + 1, dtype=np.uint64,
+        chunks=chunk_size, filters=delta_filters(np.uint64), compressors=compressor)
+    mutation_offset[:] = np.searchsorted(
+        tables.mutations.site, np.arange(ts.num_sites + 1))
+
     edges = root.create_group("edges")
-    parent = edges.empty(
-        "parent", shape=ts.num_edges, dtype=np.int32, filters=filters, compressor=compressor)
-    child = edges.empty(
-        "child", shape=ts.num_edges, dtype=np.int32, filters=filters, compressor=compressor)
-    left = edges.empty(
-        "left", shape=ts.num_edges, dtype=np.uint32,filters=filters, compressor=compressor)
-    right = edges.empty(
-        "right", shape=ts.num_edges, dtype=np.uint32,filters=filters, compressor=compressor)
-    parent[:] = tables.edges.parent
-    child[:] = tables.edges.child
-    left[:] = left_mapped
-    right[:] = right_mapped
-    # print(left.info)
-    # print(right.info)
-    # print(parent.info)
-    # print(child.info)
+    block_offset = edges.create_array(
+        "block_offset", shape=num_blocks + 1, dtype=np.uint64,
+        filters=delta_filters(np.uint64), compressors=compressor)
+    block_offset[:] = np.searchsorted(block, np.arange(num_blocks + 1))
+    columns = [
+        ("parent", np.int32, tables.edges.parent[piece]),
+        ("child", np.int32, tables.edges.child[piece]),
+        ("left", np.uint32, np.maximum(left_mapped[piece], block * block_size)),
+        ("right", np.uint32, np.minimum(right_mapped[piece], (block + 1) * block_size))]
+    for name, dtype, data in columns:
+        array = edges.create_array(
+            name, shape=len(piece), dtype=dtype, chunks=chunk_size,
+            filters=delta_filters(dtype), compressors=compressor)
+        array[:] = data
 
     mutations = root.create_group("mutations")
-    site = mutations.empty(
-        "site", shape=ts.num_mutations, dtype=np.int32, compressor=compressor)
-    node = mutations.empty(
-        "node", shape=ts.num_mutations, dtype=np.int32, compressor=compressor)
-    site[:] = tables.mutations.site
-    node[:] = tables.mutations.node
-    # print(site.info)
-    # print(node.info)
+    columns = [
+        ("site", np.int32, delta_filters(np.int32), tables.mutations.site),
+        ("node", np.int32, None, tables.mutations.node),
+        ("derived_state", np.uint8, None, tables.mutations.derived_state)]
+    for name, dtype, filters, data in columns:
+        array = mutations.create_array(
+            name, shape=ts.num_mutations, dtype=dtype, chunks=chunk_size,
+            filters=filters, compressors=compressor)
+        array[:] = data
+    store.close()
+
 
+def get_position_map(position, sequence_length):
+    """
+    Returns the sorted array of distinct coordinates that edges in a tree
+    sequence reduced to site topology can start or end at.
+    """
+    return np.unique(np.hstack([[0], position, [sequence_length]]))
+
+
+def minified_to_tables(filename, left=None, right=None):
+    """
+    Returns a TableCollection rebuilt from the specified file written by
+    ts_to_minified. If left and right are specified, only the edges, sites
+    and mutations within this interval are returned, and only the chunks of
+    the file overlapping the interval are decompressed. Node times are
+    restored exactly, but mutation times are unknown.
+    """
+    import zarr
+
+    store = zarr.storage.ZipStore(filename, mode='r')
+    root = zarr.open_group(store=store, mode='r')
+    if root.attrs.get("format_name") != "minified":
+        raise ValueError("Not a minified tree sequence: {}".format(filename))
+    sequence_length = root.attrs["sequence_length"]
+    block_size = root.attrs["block_size"]
+    left = 0 if left is None else left
+    right = sequence_length if right is None else right
+
+    position = root["sites/position"][:].astype(np.float64)
+    pos_map = get_position_map(position, sequence_length)
+    block_offset = root["edges/block_offset"]
+    num_blocks = block_offset.shape[0] - 1
+    first = np.searchsorted(pos_map, left, side="right") - 1
+    last = np.searchsorted(pos_map, right, side="left")
+    first_block = min(first // block_size, num_blocks)
+    last_block = min(-(-last // block_size), num_blocks)
+    start, stop = block_offset[[first_block, last_block]]
+    edges = {
+        name: root["edges/" + name][start: stop]
+        for name in ["left", "right", "parent", "child"]}
+    edge_left = np.maximum(pos_map[edges["left"]], left)
+    edge_right = np.minimum(pos_map[edges["right"]], right)
+    keep = edge_left < edge_right
+
+    tables = tskit.TableCollection(sequence_length=sequence_length)
+    tables.nodes.set_columns(
+        flags=root["nodes/flags"][:].astype(np.uint32), time=root["nodes/time"][:])
+    tables.edges.set_columns(
+        left=edge_left[keep], right=edge_right[keep],
+        parent=edges["parent"][keep], child=edges["child"][keep])
+
+    site_start, site_stop = np.searchsorted(position, [left, right])
+    num_sites = site_stop - site_start
+    tables.sites.set_columns(
+        position=position[site_start: site_stop],
+        ancestral_state=root["sites/ancestral_state"][site_start: site_stop].astype(
+            np.int8),
+        ancestral_state_offset=np.arange(num_sites + 1, dtype=np.uint32))
+    mutation_start, mutation_stop = root["sites/mutation_offset"][
+        [site_start, site_stop]]
+    mutations = {
+        name: root["mutations/" + name][mutation_start: mutation_stop]
+        for name in ["site", "node", "derived_state"]}
+    tables.mutations.set_columns(
+        site=(mutations["site"] - site_start).astype(np.int32), node=mutations["node"],
+        derived_state=mutations["derived_state"].astype(np.int8),
+        derived_state_offset=np.arange(
+            len(mutations["site"]) + 1, dtype=np.uint32))
     store.close()
-    store = zarr.ZipStore(filename, mode='r')
-    root = zarr.group(store=store)
-    return root
+
+    # Edges split at block boundaries are joined back together.
+    tables.edges.squash()
+    tables.sort()
+    tables.build_index()
+    tables.compute_mutation_parents()
+    return tables
+
+
+def run_benchmark_formats(args):
+    """
+    Compares the size and load time of the .trees, tszip and minified
+    formats for each of the simulations.
+    """
+    rows = []
+    for k in range(1, 8):
+        n = 10**k
+        filename = os.path.join(data_prefix, "{}.trees".format(n))
+        tsz_filename = filename + ".tsz"
+        minified_filename = filename + ".minified.zip"
+        if not os.path.exists(filename):
+            continue
+        if not os.path.exists(minified_filename):
+            ts_to_minified(tskit.load(filename), minified_filename)
+        loaders = [
+            ("trees", filename, lambda: tskit.load(filename)),
+            ("minified", minified_filename,
+                lambda: minified_to_tables(minified_filename).tree_sequence())]
+        if os.path.exists(tsz_filename):
+            loaders.append(("tszip", tsz_filename, lambda: tszip.decompress(tsz_filename)))
+        for name, path, load in loaders:
+            before = time.perf_counter()
+            load()
+            duration = time.perf_counter() - before
+            size = os.path.getsize(path)
+            rows.append({
+                "sample_size": n, "format": name, "size": size, "load_time": duration})
+            print("n = {}: {} is {} and loaded in {:.2f}s".format(
+                n, name, humanize.naturalsize(size, binary=True), duration))
+
+        # Read 1% of the genome from the middle of the minified file.
+        region_length = length / 100
+        before = time.perf_counter()
+        minified_to_tables(
+            minified_filename, (length - region_length) / 2,
+            (length + region_length) / 2)
+        duration = time.perf_counter() - before
+        rows.append({
+            "sample_size": n, "format": "minified_region", "size": 0,
+            "load_time": duration})
+        print("n = {}: loaded 1% region from minified in {:.2f}s".format(n, duration))
+    df = pd.DataFrame(rows)
+    df.to_csv("data/storing_everyone_formats.csv")
+
+
+def get_hardware_info():
+    """
+    Returns a dict describing the machine the benchmarks are run on.
+    """
+    cpu_model = platform.processor()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        memory = None
+    return {
+        "hostname": platform.node(),
+        "platform": platform.platform(),
+        "cpu_model": cpu_model,
+        "cpu_count": os.cpu_count(),
+        "memory": memory,
+        "python": platform.python_version(),
+        "versions": {
+            module.__name__: getattr(module, "__version__", None)
+            for module in [np, msprime, tskit, tszip, cyvcf2]},
+    }
+
+
+def suite_load(state, args):
+    before = time.perf_counter()
+    state["ts"] = tskit.load(state["filename"])
+    duration = time.perf_counter() - before
+    return duration, 1, 1
+
+
+def suite_trees(state, args):
+    ts = state["ts"]
+    before = time.perf_counter()
+    j = 0
+    for tree in ts.trees():
+        j += 1
+    assert j == ts.num_trees
+    duration = time.perf_counter() - before
+    return duration, ts.num_trees, ts.num_trees
+
+
+def suite_variants(state, args):
+    ts = state["ts"]
+    num_variants = min(args.num_variants, ts.num_sites)
+    before = time.perf_counter()
+    j = 0
+    for var in ts.variants():
+        if j == num_variants:
+            break
+        j += 1
+    duration = time.perf_counter() - before
+    return duration, num_variants, ts.num_sites
+
+
+def suite_newick(state, args):
+    ts = state["ts"]
+    num_trees = min(args.num_trees, ts.num_trees)
+    _, duration = time_newick(ts, num_trees)
+    return duration, num_trees, ts.num_trees
+
+
+def suite_vcf(state, args):
+    ts = state["ts"]
+    num_sites = min(args.num_variants, ts.num_sites)
+    prefix = "{}.subset_{}".format(state["filename"], num_sites)
+    bcf_filename = prefix + ".bcf"
+    if not os.path.exists(bcf_filename):
+        write_subset_bcf(ts, num_sites, prefix + ".vcf", bcf_filename)
+    before = time.perf_counter()
+    count = 0
+    for record in cyvcf2.VCF(bcf_filename):
+        count += 1
+    assert count == num_sites
+    duration = time.perf_counter() - before
+    return duration, num_sites, ts.num_sites
+
+
+def suite_tszip(state, args):
+    tsz_filename = state["filename"] + ".tsz"
+    if not os.path.exists(tsz_filename):
+        tszip.compress(state["ts"], tsz_filename)
+    before = time.perf_counter()
+    tszip.decompress(tsz_filename)
+    duration = time.perf_counter() - before
+    return duration, 1, 1
+
+
+def suite_bgen(bg, args):
+    num_variants = min(args.num_variants, bg.num_variants)
+    before = time.perf_counter()
+    for j, H in bg.iter_haplotypes(
+            0, num_variants, num_buffers=args.num_buffers,
+            num_threads=args.num_threads):
+        pass
+    duration = time.perf_counter() - before
+    return duration, num_variants, bg.num_variants
+
+
+# The load benchmark must come first, as the others use the loaded tree sequence.
+suite_operations = [
+    ("load", suite_load),
+    ("trees", suite_trees),
+    ("variants", suite_variants),
+    ("newick", suite_newick),
+    ("vcf", suite_vcf),
+    ("tszip", suite_tszip),
+]
+
+
+def suite_result(sample_size, operation, filename, timings):
+    """
+    Returns the result record for the specified list of repeated (duration,
+    count, total) timings, where count items out of total were processed.
+    The estimated time is the minimum time to process all total items over
+    the repeats, and is what we compare against the baseline, since it is
+    the least affected by noise.
+    """
+    durations = np.array([duration for duration, _, _ in timings])
+    _, count, total = timings[0]
+    scale = total / max(count, 1)
+    estimated_time = np.min(durations) * scale
+    print("n = {}: {} {} of {} in min {:.3f}s, median {:.3f}s over {} repeats "
+          "(estimated {:.2f}s for all)".format(
+              sample_size, operation, count, total, np.min(durations),
+              np.median(durations), len(durations), estimated_time))
+    return {
+        "sample_size": sample_size, "operation": operation,
+        "file": filename, "size": os.path.getsize(filename),
+        "times": list(durations), "min_time": np.min(durations),
+        "median_time": np.median(durations), "count": count, "total": total,
+        "estimated_time": estimated_time,
+        "estimated_median_time": np.median(durations) * scale}
+
+
+def result_key(result):
+    # Several BGEN files can have the same number of samples, so results
+    # are identified by the file as well.
+    return result["sample_size"], result["operation"], result["file"]
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Adds the ratio to the baseline estimated time to each of the specified
+    results and returns the list of those slower than the baseline by more
+    than the specified tolerance.
+    """
+    baseline_times = {
+        result_key(r): r["estimated_time"] for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = result_key(result)
+        if key not in baseline_times:
+            continue
+        ratio = result["estimated_time"] / baseline_times[key]
+        result["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(result)
+            print("REGRESSION: n = {}: {} on {} is {:.2f}x slower than baseline".format(
+                result["sample_size"], result["operation"], result["file"], ratio))
+    return regressions
+
+
+def run_benchmark_suite(args):
+    """
+    Runs the fixed matrix of storage and access benchmarks over the specified
+    sample sizes and BGEN files, writing the results as JSON.
+    """
+    hardware = get_hardware_info()
+    results = []
+    for n in args.sample_sizes:
+        filename = os.path.join(data_prefix, "{}.trees".format(n))
+        if not os.path.exists(filename):
+            print("Skipping n = {}: {} does not exist".format(n, filename))
+            continue
+        state = {"filename": filename}
+        for operation, func in suite_operations:
+            timings = [func(state, args) for _ in range(args.repeats)]
+            results.append(suite_result(n, operation, filename, timings))
+
+    for filename in args.bgen:
+        if simplebgen is None:
+            raise ValueError("The simplebgen module is needed for BGEN benchmarks")
+        bg = simplebgen.BgenReader(filename)
+        timings = [suite_bgen(bg, args) for _ in range(args.repeats)]
+        results.append(suite_result(bg.num_samples, "bgen", filename, timings))
+
+    output = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "hardware": hardware,
+        "config": {
+            "num_variants": args.num_variants, "num_trees": args.num_trees,
+            "num_buffers": args.num_buffers, "num_threads": args.num_threads,
+            "repeats": args.repeats},
+        "results": results,
+    }
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["hardware"]["cpu_model"] != hardware["cpu_model"]:
+            print("WARNING: baseline was run on", baseline["hardware"]["cpu_model"])
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        output["baseline"] = args.baseline
+        output["regressions"] = [
+            list(result_key(r)) for r in regressions]
+
+    tmp_file = "{}.{}.tmp".format(args.output, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(output, f, indent=2)
+    os.replace(tmp_file, args.output)
+    print("Wrote", args.output)
+    if len(regressions) > 0:
+        sys.exit("{} benchmarks regressed".format(len(regressions)))
+
 
 if __name__ == "__main__":
 
@@ -365,9 +1036,19 @@ if __name__ == "__main__":
     subparsers.dest = 'command'
 
     subparser = subparsers.add_parser("simulate")
+    subparser.add_argument(
+        "--num-processes", type=int, default=os.cpu_count(),
+        help="Maximum number of simulations to run concurrently")
+    subparser.add_argument(
+        "--memory-budget", type=float,
+        default=os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3,
+        help="Memory budget in GiB for concurrent simulations")
     subparser.set_defaults(func=run_simulate)
 
     subparser = subparsers.add_parser("convert-files")
+    subparser.add_argument(
+        "--keep-vcf", action="store_true",
+        help="Keep the uncompressed VCF files on disk")
     subparser.set_defaults(func=run_convert_files)
 
     subparser = subparsers.add_parser("make-data")
@@ -376,5 +1057,42 @@ if __name__ == "__main__":
     subparser = subparsers.add_parser("benchmark")
     subparser.set_defaults(func=run_benchmark)
 
+    subparser = subparsers.add_parser("benchmark-formats")
+    subparser.set_defaults(func=run_benchmark_formats)
+
+    subparser = subparsers.add_parser("benchmark-suite")
+    subparser.add_argument(
+        "--sample-sizes", type=int, nargs="*",
+        default=[10**k for k in range(1, 8)],
+        help="Sample sizes of the simulated tree sequences to benchmark")
+    subparser.add_argument(
+        "--bgen", nargs="*", default=[],
+        help="BGEN files to benchmark genotype decoding on")
+    subparser.add_argument(
+        "--num-variants", type=int, default=10**4,
+        help="Number of variants to decode in the variant, VCF and BGEN benchmarks")
+    subparser.add_argument(
+        "--num-trees", type=int, default=100,
+        help="Number of trees to parse in the Newick benchmark")
+    subparser.add_argument(
+        "--num-buffers", type=int, default=16,
+        help="Number of variants to decode ahead when reading BGEN")
+    subparser.add_argument(
+        "--num-threads", type=int, default=1,
+        help="Number of BGEN decoder threads")
+    subparser.add_argument(
+        "--repeats", type=int, default=5,
+        help="Number of times to run each benchmark")
+    subparser.add_argument(
+        "--output", default="data/storing_everyone_benchmark.json",
+        help="JSON file to write the results to")
+    subparser.add_argument(
+        "--baseline", default=None,
+        help="JSON results of a previous run to compare against")
+    subparser.add_argument(
+        "--tolerance", type=float, default=0.1,
+        help="Fraction by which a benchmark may be slower than the baseline")
+    subparser.set_defaults(func=run_benchmark_suite)
+
     args = parser.parse_args()
     args.func(args)